@@ -0,0 +1,236 @@
+"""
+Index of an IMERG archive: early/final run files paired by their timestamps
+"""
+import os
+import re
+import json
+import hashlib
+import datetime
+import h5py
+import numpy as np
+
+# e.g. 20000601-S000000-E002900.HDF5 or 3B-HHR-E.MS.MRG.3IMERG.20000601-S000000-E002900.0000.V06B.HDF5
+_TIMESTAMP= re.compile(r'(\d{8})-S(\d{6})-E(\d{6})')
+
+
+def readMap(h5, buffer=None, rows=None, var='Grid/precipitationCal'):
+    '''
+    Read one IMERG map, optionally into a preallocated buffer and only for a range
+    of latitude rows
+
+    Inputs:
+    ------------------
+    :h5 - str; .HDF5 file
+    :buffer - float32 array of shape (lon, rows) to read into
+    :rows - tuple; (first, last+1) latitude rows, None reads the whole map
+    :var - str; dataset path
+
+    Outputs:
+    ------------------
+    :map - (rows, lon) transposed view of the buffer, negative values set to nan
+    '''
+    with h5py.File(h5, 'r') as f:
+        dataset= f[var]
+        # IMERG stores (time, lon, lat)
+        lat_sel= slice(None) if rows is None else slice(rows[0], rows[1])
+        selection= np.s_[0, :, lat_sel] if dataset.ndim==3 else np.s_[:, lat_sel]
+        if buffer is None:
+            nlat= dataset.shape[-1] if rows is None else rows[1]-rows[0]
+            buffer= np.empty((dataset.shape[-2], nlat), dtype=np.float32)
+        dataset.read_direct(buffer, source_sel=selection)
+    # keep the transposed view instead of copying
+    arr= buffer.T
+    arr[arr<0]= np.nan
+
+    return arr
+
+def timestampKey(filename):
+    ''''%Y%m%d%H%M%S' start time of an IMERG file name, None if it has none'''
+    match= _TIMESTAMP.search(os.path.basename(filename))
+
+    return None if match is None else match.group(1)+match.group(2)
+
+def _dateKey(date):
+    if date is None:
+        return None
+    if isinstance(date, (datetime.date, datetime.datetime)):
+        return date.strftime('%Y%m%d%H%M%S')
+
+    return str(date).ljust(14, '0')
+
+def selectKey(key, start=None, end=None, months=None):
+    '''
+    True if a '%Y%m%d%H%M%S' key lies in the half open range [start, end) and in months;
+    start and end are datetime or 'YYYYmmdd[HHMMSS]' str, None is open; callers
+    looping over many keys normalize them once with _dateKey
+    '''
+    start, end= _dateKey(start), _dateKey(end)
+    if start is not None and key<start:
+        return False
+    if end is not None and key>=end:
+        return False
+    if months is not None and int(key[4:6]) not in months:
+        return False
+
+    return True
+
+
+def cachedIndex(root):
+    '''catalog index of a read-only archive root, kept in $XDG_CACHE_HOME/geoPackage (~/.cache by default)'''
+    cache= os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'geoPackage')
+    os.makedirs(cache, exist_ok=True)
+    digest= hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+
+    return os.path.join(cache, 'imerg_catalog_%s.json'%digest)
+
+class Catalog:
+    '''
+    Scans an archive root once, parses the start time of every IMERG file name and
+    pairs early and final runs. The index is cached as json so that later runs do
+    not list the directories again; top-level folders that were added, removed or
+    modified since (e.g. a new year) are rescanned when the index is loaded.
+
+    Expected layout: <root>/<year>/<day>/*.HDF5 for the early run and
+    <root>/<year><final_suffix>/<day>/*.HDF5 for the final run; any depth below the
+    year folder works.
+
+    Attributes:
+    ------------------
+    :root - str; archive root
+    :early, final - dict; {'%Y%m%d%H%M%S': path relative to root}
+    :index - str; json file caching the scan
+    :folders - dict; {top-level folder: mtime} at the time it was scanned
+
+    Methods:
+    ------------------
+    scan() - walk the root and rebuild the index
+    pairs() - (early, final) paths within a date range
+    missing() - timestamps present in only one of the runs
+    key(), buffer(), read() - reading interface shared with geoPackage.store.Store
+    '''
+
+    def __init__(self, root='.', final_suffix='_final', index=None, refresh=False):
+        '''
+        Inputs:
+        ------------------
+        :root - str; archive root
+        :final_suffix - str; suffix of the year folders holding the final run
+        :index - str; json index path, by default <root>/.imerg_catalog.json, or a file
+                 in the user cache directory (see cachedIndex) when root is not writable
+        :refresh - bool; rescan everything even if the index exists, e.g. after files
+                   were added inside an existing day folder
+        '''
+        self.root= root
+        self.final_suffix= final_suffix
+        if index is None:
+            index= os.path.join(root, '.imerg_catalog.json')
+            if not os.access(root, os.W_OK):
+                index= cachedIndex(root)
+        self.index= index
+        self.early= {}
+        self.final= {}
+        self.folders= {}
+        if not refresh and os.path.exists(self.index):
+            self.load()
+            stale= self.stale()
+            if stale:
+                self.scan(stale)
+                self.save()
+        else:
+            self.scan()
+            self.save()
+
+    def scan(self, folders=None):
+        '''
+        :folders - list of top-level folder names to rescan, None rescans the whole root
+        '''
+        if folders is None:
+            self.early, self.final, self.folders= {}, {}, {}
+            folders= list(self._topFolders().keys())
+        folders= set(folders)
+        for run in (self.early, self.final):
+            for key in [key for key, path in run.items() if path.split(os.sep)[0] in folders]:
+                del run[key]
+        current= self._topFolders()
+        for top in folders:
+            self.folders.pop(top, None)
+            if top not in current:
+                continue
+            self.folders[top]= current[top]
+            run= self.final if top.endswith(self.final_suffix) else self.early
+            for folder, _, files in os.walk(os.path.join(self.root, top)):
+                relfolder= os.path.relpath(folder, self.root)
+                for name in files:
+                    key= timestampKey(name)
+                    if key is None or not name.lower().endswith(('.hdf5', '.h5')):
+                        continue
+                    run[key]= os.path.join(relfolder, name)
+
+        return self
+
+    def stale(self):
+        '''top-level folders added, removed or modified since they were scanned'''
+        current= self._topFolders()
+
+        return sorted(top for top in set(current).union(self.folders) if current.get(top)!=self.folders.get(top))
+
+    def save(self):
+        tmp= self.index+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'final_suffix': self.final_suffix, 'early': self.early, 'final': self.final,
+                       'folders': self.folders}, f)
+        os.replace(tmp, self.index)
+
+    def load(self):
+        with open(self.index) as f:
+            index= json.load(f)
+        # indexes written before folders were tracked are rescanned as a whole
+        self.early, self.final, self.folders= index['early'], index['final'], index.get('folders', {})
+
+        return self
+
+    def _topFolders(self):
+        return {entry.name: entry.stat().st_mtime_ns for entry in os.scandir(self.root) if entry.is_dir()}
+
+    def pairs(self, start=None, end=None, months=None, strict=False):
+        '''
+        Inputs:
+        ------------------
+        :start, end - datetime.datetime or 'YYYYmmdd[HHMMSS]' str; half open range [start, end)
+        :months - list of int; only keep these calendar months
+        :strict - bool; raise FileNotFoundError if a timestamp in range lacks one of the runs
+
+        Outputs:
+        ------------------
+        :pairs - list of (early, final) file paths sorted by time
+        '''
+        start, end= _dateKey(start), _dateKey(end)
+        if strict:
+            missing= self.missing(start, end, months)
+            if missing:
+                raise FileNotFoundError('%d timestamps miss the early or final run, e.g. %s'%(len(missing), missing[:5]))
+        keys= sorted(key for key in self.early if key in self.final and selectKey(key, start, end, months))
+
+        return [(os.path.join(self.root, self.early[key]), os.path.join(self.root, self.final[key])) for key in keys]
+
+    def missing(self, start=None, end=None, months=None):
+        start, end= _dateKey(start), _dateKey(end)
+        keys= set(self.early).symmetric_difference(self.final)
+
+        return sorted(key for key in keys if selectKey(key, start, end, months))
+
+    def key(self, ref):
+        '''manifest key of a file returned by pairs()'''
+        return os.path.basename(ref)
+
+    def buffer(self, shape, rows=None):
+        '''float32 buffer read() fills for a (lat, lon) grid, or for a range of its rows'''
+        nrows= shape[0] if rows is None else rows[1]-rows[0]
+
+        return np.empty((shape[1], nrows), dtype=np.float32)
+
+    def read(self, ref, buffer=None, rows=None):
+        return readMap(ref, buffer, rows)
+
+    def timestamps(self):
+        return [datetime.datetime.strptime(key, '%Y%m%d%H%M%S') for key in sorted(self.early) if key in self.final]
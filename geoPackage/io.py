@@ -1,25 +1,255 @@
 import pandas as pd
 import h5py
 import numpy as np
-from osgeo import gdal
+from osgeo import gdal, gdal_array, osr
 import geopandas as gpd
+import shapely
+import pyproj
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import functools
+import importlib.util
+import os
+import queue
+import re
+import threading
+import weakref
+from .catalog import selectKey, timestampKey, _dateKey
 
 class ReadFile:
-    def __init__(self, filename):
-        if filename.endswith('h5'):
-            self.layer= H5(filename)
-        # self.sample= h5py.File('test_sample.HDF5','r')
-        elif filename.endswith('.tif') or filename.endswith('.tiff'):
-            self.raster= Raster(filename)
+    '''
+    Open a raster, vector or HDF5 file. The format is sniffed from the leading bytes
+    of the file (GDAL driver identification as a fallback) and dispatched to the
+    reader registered for it, see registerReader(). Opened objects are kept in an
+    LRU pool keyed by path, modification time, read options and calling thread, so
+    repeated calls of a thread on an unchanged file reuse the same handle; see
+    setPoolSize(). Pooled objects (and their cached arrays) are shared by those
+    calls: treat them as read-only and do not hand them to other threads, GDAL
+    datasets are not thread-safe.
+
+    Attributes:
+    ------------------
+    :layer - geoPackage.io.H5 for HDF5 files
+    :raster - geoPackage.io.Raster for GeoTIFF, NetCDF and other GDAL rasters
+    :vector - geoPackage.io.Vector for shapefiles, GeoPackages and other OGR vectors
+    :format - str; name of the reader used
+    '''
+    def __init__(self, filename, format=None, pool=True, **kwargs):
+        '''
+        :format - str; registered reader name, skips sniffing
+        :pool - bool; reuse pooled handles, False always opens a new one
+        :kwargs - read options of the reader, e.g. Vector (bbox, mask, columns, rows,
+                  lazy, engine), H5 (rdcc_nbytes, rdcc_nslots), NetCDF (variable)
+        '''
+        if format is None:
+            format= sniffFormat(filename)
+        if format not in _READERS:
+            raise ValueError('format %s not in %s'%(format, list(_READERS.keys())))
+        attribute, _, opener= _READERS[format]
+        self.format= format
+        setattr(self, attribute, _openPooled(filename, format, opener, kwargs) if pool else opener(filename, **kwargs))
+
+
+# readers by format name, {name: (ReadFile attribute, sniff(filename, header), opener(filename, **kwargs))}
+_READERS= collections.OrderedDict()
+# catch-all readers, always sniffed after the specific formats
+_FALLBACK_READERS= ('ogr', 'gdal')
+_HEADER_SIZE= 100
+
+def registerReader(name, attribute, sniff, opener, before=None):
+    '''
+    Register a format for ReadFile. Formats are sniffed in order; new readers go
+    before the generic GDAL/OGR fallbacks ('ogr', 'gdal'), which would otherwise
+    claim any file GDAL identifies. A reader registered again under an existing
+    name replaces it in place.
+
+    Inputs:
+    ------------------
+    :name - str; format name
+    :attribute - str; ReadFile attribute holding the opened object ('raster', 'vector' or 'layer')
+    :sniff - callable(filename, header) -> bool; header holds the first 100 bytes
+             of the file, b'' if it can not be read
+    :opener - callable(filename, **kwargs) -> opened object
+    :before - str; name of the reader to sniff after this one, by default the first
+              fallback; None with no fallback registered appends
+    '''
+    if name in _READERS:
+        _READERS[name]= (attribute, sniff, opener)
+        return
+    if before is None and name not in _FALLBACK_READERS:
+        before= next((fallback for fallback in _FALLBACK_READERS if fallback in _READERS), None)
+    elif before is not None and before not in _READERS:
+        raise ValueError('reader %s not in %s'%(before, list(_READERS.keys())))
+    _READERS[name]= (attribute, sniff, opener)
+    if before is not None:
+        # move the readers from `before` onwards behind the new one
+        for other in list(_READERS.keys())[list(_READERS.keys()).index(before):-1]:
+            _READERS.move_to_end(other)
+
+def sniffFormat(filename):
+    '''name of the first registered reader recognizing the file'''
+    header= b''
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as f:
+            header= f.read(_HEADER_SIZE)
+    for name, (_, sniff, _) in _READERS.items():
+        if sniff(filename, header):
+            return name
+    if not os.path.exists(filename) and not filename.startswith('/vsi'):
+        raise FileNotFoundError('%s does not exist!'%filename)
+    raise ValueError('format of %s not recognized, registered formats are %s'%(filename, list(_READERS.keys())))
+
+def _hasExtension(filename, *extensions):
+    return filename.lower().endswith(extensions)
+
+def _isHDF5(filename, header):
+    # netCDF-4 files are HDF5 files too, they are told apart by their extension
+    return header.startswith(b'\x89HDF\r\n\x1a\n') and not _hasExtension(filename, '.nc', '.nc4')
+
+def _isNetCDF(filename, header):
+    if header.startswith(b'CDF\x01') or header.startswith(b'CDF\x02') or header.startswith(b'CDF\x05'):
+        return True
+    return header.startswith(b'\x89HDF\r\n\x1a\n') and _hasExtension(filename, '.nc', '.nc4')
+
+def _isTIFF(filename, header):
+    return header[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')
+
+def _isGeoPackage(filename, header):
+    # sqlite file with the GeoPackage application id at byte 68
+    return header.startswith(b'SQLite format 3\x00') and header[68:72] in (b'GPKG', b'GP10', b'GP11')
+
+def _isShapefile(filename, header):
+    # big-endian file code 9994
+    return header[:4]==b'\x00\x00\x27\x0a' and _hasExtension(filename, '.shp')
+
+def _isGDALVector(filename, header):
+    return gdal.IdentifyDriverEx(filename, gdal.OF_VECTOR) is not None
+
+def _isGDALRaster(filename, header):
+    return gdal.IdentifyDriverEx(filename, gdal.OF_RASTER) is not None
+
+def _openNetCDF(filename, variable=None, cache=True):
+    '''Raster of a NetCDF file, or of one of its variables through the GDAL subdataset syntax'''
+    return Raster(filename if variable is None else 'NETCDF:"%s":%s'%(filename, variable), cache=cache)
+
+# open handles, {(path, mtime, format, options, thread): object}; a thread never gets
+# the handle of another one, GDAL and h5py handles are not safe to share across threads
+_HANDLE_POOL= collections.OrderedDict()
+_HANDLE_POOL_SIZE= 32
+_HANDLE_LOCK= threading.Lock()
+
+def setPoolSize(size):
+    '''
+    Maximum number of handles ReadFile keeps open; least recently used handles are
+    dropped first and closed once no other reference to them is left. 0 disables pooling.
+    '''
+    global _HANDLE_POOL_SIZE
+    if size<0:
+        raise ValueError('expected a pool size >=0, but got %d'%size)
+    with _HANDLE_LOCK:
+        _HANDLE_POOL_SIZE= size
+        while len(_HANDLE_POOL)>_HANDLE_POOL_SIZE:
+            _HANDLE_POOL.popitem(last=False)
+
+def clearPool():
+    '''drop every pooled handle'''
+    with _HANDLE_LOCK:
+        _HANDLE_POOL.clear()
+
+def _optionKey(value):
+    if hasattr(value, 'wkb'):
+        return value.wkb
+    if isinstance(value, slice):
+        return (value.start, value.stop, value.step)
+    if isinstance(value, (list, tuple)):
+        return tuple(_optionKey(v) for v in value)
+    return value
+
+def _openPooled(filename, format, opener, kwargs):
+    try:
+        stat= os.stat(filename)
+        version= (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        version= None
+    key= (os.path.abspath(filename), version, format, tuple(sorted((k, _optionKey(v)) for k, v in kwargs.items())),
+          threading.get_ident())
+    try:
+        hash(key)
+    except TypeError:
+        return opener(filename, **kwargs)
+    with _HANDLE_LOCK:
+        # skip h5 handles the caller closed in the meantime
+        if key in _HANDLE_POOL and not (isinstance(_HANDLE_POOL[key], H5) and not _HANDLE_POOL[key].layer):
+            _HANDLE_POOL.move_to_end(key)
+            return _HANDLE_POOL[key]
+    handle= opener(filename, **kwargs)
+    with _HANDLE_LOCK:
+        if _HANDLE_POOL_SIZE>0:
+            _HANDLE_POOL[key]= handle
+            while len(_HANDLE_POOL)>_HANDLE_POOL_SIZE:
+                _HANDLE_POOL.popitem(last=False)
 
-        elif filename.endswith('.shp') or filename.endswith('.gpdk'):
-            self.vector= Vector(filename)
+    return handle
 
 
 class Raster():
-    def __init__(self, filename):
+    '''
+    GDAL backed raster. The decoded array is cached on first access of `array`,
+    call `invalidate()` after the underlying file changed on disk.
+
+    Uncompressed ENVI rasters (see toENVI) are not decoded at all: `array` is a
+    read-only np.memmap of the file, so windows are zero-copy views and processes
+    opening the same file share the pages of the OS cache.
+
+    Inputs:
+    ------------------
+    :filename - str; raster file path
+    :cache - bool; keep the decoded array in memory after the first read
+    :layer - gdal.Dataset; wrap an already opened (e.g. in-memory) dataset
+    :memmap - bool; memory-map the raster, by default for ENVI files
+    '''
+    def __init__(self, filename, cache=True, layer=None, memmap=None):
         self.filename= filename
-        self.layer= gdal.Open(filename)
+        self.layer= gdal.Open(filename) if layer is None else layer
+        self.cache= cache
+        self._array= None
+        if memmap is None:
+            memmap= self.layer is not None and self.layer.GetDriver().ShortName=='ENVI'
+        self.memmap= memmap
+
+    @classmethod
+    def fromArray(cls, arr, geotransform, crs='', nodata=None):
+        '''
+        Build an in-memory raster (GDAL MEM driver) from a numpy array
+
+        Inputs:
+        ------------------
+        :arr - numpy array of shape (rows, cols) or (bands, rows, cols)
+        :geotransform - tuple; GDAL geotransform
+        :crs - str; projection WKT
+        :nodata - nodata value set on every band
+
+        Outputs:
+        ------------------
+        :raster - geoPackage.io.Raster object with the array already cached
+        '''
+        arr= np.ascontiguousarray(arr)
+        bands_arr= arr[np.newaxis] if arr.ndim==2 else arr
+        nbands, rows, cols= bands_arr.shape
+        dtype= gdal_array.NumericTypeCodeToGDALTypeCode(arr.dtype.type)
+        ds= gdal.GetDriverByName('MEM').Create('', cols, rows, nbands, dtype)
+        ds.SetGeoTransform(tuple(geotransform))
+        if crs:
+            ds.SetProjection(crs)
+        for i in range(nbands):
+            band= ds.GetRasterBand(i+1)
+            band.WriteArray(bands_arr[i])
+            if nodata is not None:
+                band.SetNoDataValue(nodata)
+        raster= cls('', layer=ds)
+        raster._array= arr
+
+        return raster
 
     @property
     def types(self):
@@ -33,28 +263,432 @@ class Raster():
     def crs(self):
         return self.layer.GetProjection()
 
+    @property
+    def shape(self):
+        '''(rows, cols) of the raster, without decoding any pixel'''
+        return self.layer.RasterYSize, self.layer.RasterXSize
+
+    @property
+    def bands(self):
+        return self.layer.RasterCount
+
+    @property
+    def bounds(self):
+        '''(xmin, ymin, xmax, ymax) extent of the raster'''
+        Xori, Xres, Xskew, Yori, Yskew, Yres= self.geotransform
+        rows, cols= self.shape
+        xs= [Xori+ x*Xres+ y*Xskew for x, y in ((0, 0), (cols, 0), (0, rows), (cols, rows))]
+        ys= [Yori+ x*Yskew+ y*Yres for x, y in ((0, 0), (cols, 0), (0, rows), (cols, rows))]
+
+        return min(xs), min(ys), max(xs), max(ys)
+
+    @property
+    def nodata(self):
+        return self.layer.GetRasterBand(1).GetNoDataValue()
+
     @property
     def array(self):
-        return self.layer.ReadAsArray()
+        if self._array is not None:
+            return self._array
+        if self.memmap:
+            # a mapping costs no memory, keep it whatever the cache setting
+            self._array= _memmapENVI(self.filename)
+            return self._array
+        arr= self.layer.ReadAsArray()
+        if self.cache:
+            self._array= arr
+
+        return arr
 
     @property
     def filepath(self):
         return self.filename
 
+    def read_window(self, xoff, yoff, xsize, ysize, band=None):
+        '''
+        Read a block of the raster without decoding the whole file
+
+        Inputs:
+        ------------------
+        :xoff, yoff - int; column and row offset of the upper left pixel
+        :xsize, ysize - int; number of columns and rows to read
+        :band - int; 1-based band index, None reads all bands
+
+        Outputs:
+        ------------------
+        :arr - numpy array of shape (ysize, xsize), or (bands, ysize, xsize) for
+               multi-band rasters when band is None
+        '''
+        rows, cols= self.shape
+        if xoff<0 or yoff<0 or xoff+xsize>cols or yoff+ysize>rows:
+            raise ValueError('window (%d, %d, %d, %d) out of raster bounds %s'%(xoff, yoff, xsize, ysize, str(self.shape)))
+        if self._array is None and self.memmap:
+            self.array
+        if self._array is not None:
+            arr= self._array if self._array.ndim==3 else self._array[np.newaxis]
+            if band is None:
+                return self._array[..., yoff:yoff+ysize, xoff:xoff+xsize]
+            return arr[band-1, yoff:yoff+ysize, xoff:xoff+xsize]
+        if band is None:
+            return self.layer.ReadAsArray(xoff, yoff, xsize, ysize)
+
+        return self.layer.GetRasterBand(band).ReadAsArray(xoff, yoff, xsize, ysize)
+
+    def invalidate(self):
+        '''drop the cached array so that the next access re-reads from disk'''
+        self._array= None
+
+    def iter_blocks(self, band=1, halo=0, blocksize=None):
+        '''
+        Walk the raster along its natural GDAL blocks without loading it whole
+
+        Inputs:
+        ------------------
+        :band - int; 1-based band index
+        :halo - int; extra pixels read around every block for focal operations, edges
+                of the raster are padded by repeating the border pixels
+        :blocksize - tuple; (xsize, ysize), by default the GDAL block size, with strips
+                     grouped to about one million pixels
+
+        Outputs:
+        ------------------
+        :generator of (Window, array); the window is the block without halo, the array
+         has shape (ysize+2*halo, xsize+2*halo)
+        '''
+        for window in self.windows(band, blocksize):
+            yield window, self._readHalo(window, band, halo)
+
+    def windows(self, band=1, blocksize=None):
+        '''Window of every block visited by iter_blocks, in row-major order'''
+        rows, cols= self.shape
+        if blocksize is None:
+            xsize, ysize= self.layer.GetRasterBand(band).GetBlockSize()
+            if xsize>=cols:
+                ysize= max(ysize, (1<<20)//max(cols, 1))
+        else:
+            xsize, ysize= blocksize
+
+        return [Window(xoff, yoff, min(xsize, cols-xoff), min(ysize, rows-yoff))
+                for yoff in range(0, rows, ysize) for xoff in range(0, cols, xsize)]
+
+    def map_blocks(self, func, out=None, band=1, halo=0, blocksize=None, processes=None, dtype=np.float32,
+                   nodata=None, **options):
+        '''
+        Apply func block by block and write the result through a tiled BlockWriter,
+        so memory stays bounded by a few blocks regardless of the raster size
+
+        Inputs:
+        ------------------
+        :func - callable; takes the block array (with halo) and returns an array of the
+                same shape or of the block shape without halo; must be picklable
+                (a module-level function) when processes is set
+        :out - str; output GeoTIFF path, None returns an in-memory raster
+        :band, halo, blocksize - see iter_blocks
+        :processes - int; run func in a process pool, workers read their blocks themselves
+        :dtype - numpy dtype of the output
+        :nodata - nodata value of the output
+        :options - GTiff creation options passed to BlockWriter
+
+        Outputs:
+        ------------------
+        :raster - geoPackage.io.Raster of the result
+        '''
+        windows= self.windows(band, blocksize)
+        if processes and not os.path.exists(self.filename):
+            raise ValueError('processes need a raster backed by a file, not %s'%(self.filename or 'an in-memory dataset'))
+        if out is None:
+            result= np.empty(self.shape, dtype=dtype)
+
+            def write(arr, window):
+                result[window.yoff:window.yoff+window.ysize, window.xoff:window.xoff+window.xsize]= arr
+
+            self._mapWindows(func, windows, band, halo, processes, write)
+
+            return Raster.fromArray(result, self.geotransform, crs=self.crs, nodata=nodata)
+        with BlockWriter(out, self.shape, self.geotransform, self.crs, dtype=dtype, nodata=nodata, **options) as writer:
+            self._mapWindows(func, windows, band, halo, processes,
+                             lambda arr, window: writer.write_block(arr, window.xoff, window.yoff))
+
+        return Raster(out)
+
+    def _mapWindows(self, func, windows, band, halo, processes, write):
+        if not processes:
+            for window in windows:
+                write(_trimHalo(func(self._readHalo(window, band, halo)), window, halo), window)
+            return
+        with ProcessPoolExecutor(processes) as executor:
+            # keep a bounded number of blocks in flight
+            pending= collections.deque()
+            for window in windows:
+                pending.append((window, executor.submit(_mapBlock, self.filename, window, band, halo, func)))
+                if len(pending)>=2*processes:
+                    done, future= pending.popleft()
+                    write(future.result(), done)
+            while pending:
+                done, future= pending.popleft()
+                write(future.result(), done)
+
+    def _readHalo(self, window, band, halo):
+        '''read a window grown by halo pixels, edge-padded outside the raster'''
+        if halo==0:
+            return self.read_window(window.xoff, window.yoff, window.xsize, window.ysize, band=band)
+        rows, cols= self.shape
+        x0, y0= max(window.xoff-halo, 0), max(window.yoff-halo, 0)
+        x1, y1= min(window.xoff+window.xsize+halo, cols), min(window.yoff+window.ysize+halo, rows)
+        arr= self.read_window(x0, y0, x1-x0, y1-y0, band=band)
+        pad= ((y0-(window.yoff-halo), window.yoff+window.ysize+halo-y1),
+              (x0-(window.xoff-halo), window.xoff+window.xsize+halo-x1))
+
+        return np.pad(arr, pad, mode='edge') if any(sum(pad, ())) else arr
+
+# loaded GeoDataFrames, least recently used first
+_FRAME_CACHE= collections.OrderedDict()
+_FRAME_CACHE_SIZE= 16
+
+def _readFrame(filename, bbox=None, mask=None, columns=None, rows=None, engine=None):
+    '''
+    gpd.read_file with bbox/mask/columns/rows pruning and an LRU cache of the results;
+    the frame is indexed by the feature ids of the file ('fid'), so features keep
+    their ids whatever subset is read
+    '''
+    if engine is None:
+        engine= 'pyogrio' if _hasModule('pyogrio') else 'fiona'
+    key= None
+    if mask is None or hasattr(mask, 'wkb'):
+        key= (os.path.abspath(filename), os.path.getmtime(filename) if os.path.exists(filename) else None,
+              None if bbox is None else tuple(bbox), None if mask is None else mask.wkb,
+              None if columns is None else tuple(columns),
+              (rows.start, rows.stop, rows.step) if isinstance(rows, slice) else rows, engine)
+        if key in _FRAME_CACHE:
+            _FRAME_CACHE.move_to_end(key)
+            return _FRAME_CACHE[key]
+    if engine=='fiona':
+        frame= _readFiona(filename, bbox, mask, columns, rows)
+    else:
+        frame= _readPyogrio(filename, bbox, mask, columns, rows)
+    if key is not None:
+        _FRAME_CACHE[key]= frame
+        while len(_FRAME_CACHE)>_FRAME_CACHE_SIZE:
+            _FRAME_CACHE.popitem(last=False)
+
+    return frame
+
+def _readPyogrio(filename, bbox, mask, columns, rows):
+    kwargs= {'engine': 'pyogrio', 'fid_as_index': True}
+    if bbox is not None:
+        kwargs['bbox']= tuple(bbox)
+    if mask is not None:
+        kwargs['mask']= mask
+    if rows is not None:
+        kwargs['rows']= rows
+    if columns is not None:
+        kwargs['columns']= list(columns)
+    if _hasModule('pyarrow'):
+        kwargs['use_arrow']= True
+
+    return gpd.read_file(filename, **kwargs)
+
+def _readFiona(filename, bbox, mask, columns, rows):
+    # gpd.read_file drops the fids with fiona, read the features with their ids instead
+    import fiona
+    with fiona.open(filename, **({} if columns is None else {'include_fields': list(columns)})) as src:
+        if rows is None:
+            args= ()
+        elif isinstance(rows, slice):
+            args= (rows.start, rows.stop, rows.step)
+        else:
+            args= (rows,)
+        if mask is not None and not hasattr(mask, 'wkb'):
+            mask= shapely.union_all(np.asarray(mask.geometry))
+        items= list(src.items(*args, bbox=None if bbox is None else tuple(bbox),
+                              mask=None if mask is None else shapely.geometry.mapping(mask)))
+        frame= gpd.GeoDataFrame.from_features([feature for _, feature in items], crs=src.crs,
+                                              columns=None if columns is None else ['geometry']+list(columns))
+        frame.index= pd.Index([fid for fid, _ in items], dtype=np.int64, name='fid')
+
+    return frame
+
+# reprojected copies of vectors, {vector: {target crs wkt: Vector}}
+_ALIGNED= weakref.WeakKeyDictionary()
+
+@functools.lru_cache(maxsize=32)
+def _transformer(src, dst):
+    '''pyproj transformer between two crs WKT, built once per pair'''
+    return pyproj.Transformer.from_crs(pyproj.CRS.from_wkt(src), pyproj.CRS.from_wkt(dst), always_xy=True)
+
+def _crs(crs):
+    '''pyproj.CRS of a WKT string, EPSG code or pyproj.CRS; None if undefined'''
+    if crs is None or (isinstance(crs, str) and not crs.strip()):
+        return None
+    return pyproj.CRS.from_user_input(crs)
+
+def _hasModule(name):
+    return importlib.util.find_spec(name) is not None
+
+Window= collections.namedtuple('Window', ['xoff', 'yoff', 'xsize', 'ysize'])
+
+def _trimHalo(arr, window, halo):
+    if halo and arr.shape==(window.ysize+2*halo, window.xsize+2*halo):
+        return arr[halo:-halo, halo:-halo]
+    return arr
+
+# rasters opened by map_blocks workers, one handle per file and process
+_WORKER_RASTERS= {}
+
+def _mapBlock(filename, window, band, halo, func):
+    if filename not in _WORKER_RASTERS:
+        _WORKER_RASTERS[filename]= Raster(filename, cache=False)
+
+    return _trimHalo(func(_WORKER_RASTERS[filename]._readHalo(window, band, halo)), window, halo)
+
 class Vector:
-    def __init__(self, filename):
+    '''
+    Vector file loaded as a geopandas.GeoDataFrame. Loaded frames are cached per
+    file and read options, so several Vector objects (and Geoprocess calls) on the
+    same shapefile parse it once; treat `layer` as read-only.
+
+    Inputs:
+    ------------------
+    :filename - str; vector file path
+    :bbox - tuple; (xmin, ymin, xmax, ymax) only read features intersecting it
+    :mask - shapely geometry; only read features intersecting it
+    :columns - list of str; attribute columns to read, [] reads the geometry only
+    :rows - int or slice; only read these rows
+    :lazy - bool; defer reading until `layer` is first accessed
+    :engine - str; 'pyogrio' or 'fiona', by default pyogrio (arrow enabled) when installed
+    '''
+    def __init__(self, filename, bbox=None, mask=None, columns=None, rows=None, lazy=False, engine=None):
         self.filename= filename
-        self.layer= gpd.read_file(filename)
+        self.bbox= bbox
+        self.mask= mask
+        self.columns= columns
+        self.rows= rows
+        self.engine= engine
+        self._layer= None
+        if not lazy:
+            self.layer
+
+    @property
+    def layer(self):
+        if self._layer is None:
+            self._layer= _readFrame(self.filename, self.bbox, self.mask, self.columns, self.rows, self.engine)
+        return self._layer
+
+    @layer.setter
+    def layer(self, frame):
+        self._layer= frame
 
     # @property
     # def geometry(self):
     #     '''Return X, Y'''
     #     return [list(self.layer.geometry)[0] for i in range(len(self.layer))], [list(self.layer.geometry)[1] for i in range(len(self.layer))]
 
+    @classmethod
+    def fromFrame(cls, frame, filename=''):
+        '''
+        Wrap an in-memory geopandas.GeoDataFrame
+
+        Inputs:
+        ------------------
+        :frame - geopandas.GeoDataFrame
+        :filename - str; file the frame was read from, '' if it only lives in memory
+        '''
+        vector= cls(filename, lazy=True)
+        vector.layer= frame
+
+        return vector
+
     @property
     def head(self):
         return self.layer.head()
 
+    def to_crs(self, crs):
+        '''
+        Vector reprojected to a crs. Coordinates of all features are transformed in
+        one call with a cached pyproj transformer, and the result is memoized per
+        target crs, so repeated calls return the same object.
+
+        Inputs:
+        ------------------
+        :crs - WKT str (e.g. Raster.crs), 'EPSG:<code>' or pyproj.CRS
+
+        Outputs:
+        ------------------
+        :vector - self if either crs is undefined or both are equal, otherwise an
+                  in-memory geoPackage.io.Vector
+        '''
+        key= crs if isinstance(crs, str) or crs is None else _crs(crs).to_wkt()
+        cache= _ALIGNED.setdefault(self, {})
+        if key not in cache:
+            src, dst= _crs(self.crs), _crs(crs)
+            if src is None or dst is None or src.equals(dst, ignore_axis_order=True):
+                # None stands for self, a reference to self would keep the weak key alive
+                cache[key]= None
+            else:
+                transformer= _transformer(src.to_wkt(), dst.to_wkt())
+                frame= self.layer
+                geometry= shapely.transform(frame.geometry.values,
+                                            lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1])))
+                frame= frame.set_geometry(gpd.GeoSeries(geometry, index=frame.index, crs=dst), crs=dst)
+                cache[key]= Vector.fromFrame(frame)
+
+        return self if cache[key] is None else cache[key]
+
+    def query(self, bounds, predicate='intersects'):
+        '''
+        Inputs:
+        ------------------
+        :bounds - tuple; (xmin, ymin, xmax, ymax) or a geoPackage.io.Raster whose extent is used
+        :predicate - str; spatial predicate of the STRtree query
+
+        Outputs:
+        ------------------
+        :index - sorted int array of the positions of matching features
+        '''
+        if isinstance(bounds, Raster):
+            bounds= bounds.bounds
+        index= self.layer.sindex.query(shapely.box(*bounds), predicate=predicate)
+
+        return np.sort(index)
+
+    def within(self, raster):
+        '''boolean mask of the features intersecting the extent of a raster'''
+        mask= np.zeros(len(self.layer), dtype=bool)
+        mask[self.query(raster)]= True
+
+        return mask
+
+    def queryTiles(self, raster, blocksize=None, predicate='intersects'):
+        '''
+        Bulk STRtree query of the features touching every block of a raster grid
+
+        Inputs:
+        ------------------
+        :raster - geoPackage.io.Raster
+        :blocksize - tuple; (xsize, ysize) tiles, by default the raster blocks (see Raster.windows)
+
+        Outputs:
+        ------------------
+        :tiles - dict {Window: sorted int array of feature positions}, tiles without
+                 features are left out
+        '''
+        windows= raster.windows(blocksize=blocksize)
+        Xori, Xres, Xskew, Yori, Yskew, Yres= raster.geotransform
+        xoff= np.array([w.xoff for w in windows], dtype=np.float64)
+        yoff= np.array([w.yoff for w in windows], dtype=np.float64)
+        xend= xoff+ np.array([w.xsize for w in windows])
+        yend= yoff+ np.array([w.ysize for w in windows])
+        # corners of every tile in world coordinates
+        xs= np.stack([Xori+x*Xres+y*Xskew for x, y in ((xoff, yoff), (xend, yoff), (xoff, yend), (xend, yend))])
+        ys= np.stack([Yori+x*Yskew+y*Yres for x, y in ((xoff, yoff), (xend, yoff), (xoff, yend), (xend, yend))])
+        boxes= shapely.box(xs.min(axis=0), ys.min(axis=0), xs.max(axis=0), ys.max(axis=0))
+        tile_idx, feature_idx= self.layer.sindex.query(boxes, predicate=predicate)
+        order= np.lexsort((feature_idx, tile_idx))
+        tile_idx, feature_idx= tile_idx[order], feature_idx[order]
+        tiles, starts= np.unique(tile_idx, return_index=True)
+
+        return {windows[t]: ids for t, ids in zip(tiles, np.split(feature_idx, starts[1:]))}
+
     @property
     def crs(self):
         return self.layer.crs
@@ -63,80 +697,541 @@ class Vector:
     def filepath(self):
         return self.filename
 
+class LazyArray:
+    '''
+    Proxy of an HDF5 dataset supporting NumPy-style slicing; only the requested
+    hyperslab is read. np.asarray(proxy) or proxy[:] reads everything.
+    '''
+    def __init__(self, dataset):
+        self.dataset= dataset
+
+    @property
+    def shape(self):
+        return self.dataset.shape
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    @property
+    def ndim(self):
+        return self.dataset.ndim
+
+    @property
+    def size(self):
+        return self.dataset.size
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, key):
+        return self.dataset[key]
+
+    def __array__(self, dtype=None, copy=None):
+        arr= self.dataset[()]
+
+        return arr if dtype is None else arr.astype(dtype)
+
+    def read(self):
+        return self.dataset[()]
+
+    def __repr__(self):
+        return '<LazyArray %s: shape %s, dtype %s>'%(self.dataset.name, str(self.shape), str(self.dtype))
+
 class H5:
     '''
     Typical NASA IMERG .HDF5 format, which includes attribute ['Grid/lons', 'Grid/lats', 'Grid/precipitationUncal',
     'Grid/precipitationCal'] ...
+
+    Datasets are exposed as LazyArray proxies, e.g. h5['Grid/precipitationCal'][0, :100, :50]
+    reads only that block; lats and lons are small and kept in memory once read.
+
+    Inputs:
+    ------------------
+    :filename - str
+    :rdcc_nbytes - int; HDF5 chunk cache size in bytes, the h5py default is 1 MB
+    :rdcc_nslots - int; number of chunk cache hash slots
     '''
-    def __init__(self, filename):
-        self.layer= h5py.File(filename, 'r')
+    def __init__(self, filename, rdcc_nbytes=None, rdcc_nslots=None):
+        self.filename= filename
+        self.layer= h5py.File(filename, 'r', rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots)
         self._attrs= self.layer.keys()
+        self._coords= {}
 
     @property
     def types(self):
         return type(self.layer)
 
+    def __getitem__(self, path):
+        if path not in self.layer:
+            raise KeyError('%s not in %s!'%(path, list(self._attrs)))
+        return LazyArray(self.layer[path])
+
+    def __contains__(self, path):
+        return path in self.layer
+
+    def close(self):
+        self.layer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     @property
     def rmse(self):
-        if 'rmse' in self._attrs:
-            return self.layer['rmse'][:]
-        else:
-            raise AttributeError('rmse not in %s!'%(list(self._attrs)))
+        return self._dataset('rmse')
 
     @property
     def mae(self):
-        if 'mae' in self._attrs:
-            return self.layer['mae'][:]
-        else:
-            raise AttributeError('mae not in %s!'%(list(self._attrs)))
+        return self._dataset('mae')
 
     @property
     def prob(self):
-        if 'prob' in self._attrs :
-            return self.layer['prob'][:]
-        else:
-            raise AttributeError('prob not in %s!'%(list(self._attrs)))
+        return self._dataset('prob')
 
     @property
     def lats(self):
-        if 'lats' in self._attrs :
-            return self.layer['Grid/lats'][:]
-        else:
-            raise AttributeError('lats not in %s!'%(list(self._attrs)))
+        return self._coordinate('lats')
 
     @property
     def lons(self):
-        if 'lons' in self._attrs :
-            return self.layer['Grid/lons'][:]
+        return self._coordinate('lons')
+
+    def _dataset(self, name):
+        if name in self.layer:
+            return LazyArray(self.layer[name])
         else:
-            raise AttributeError('lons not in %s!'%(list(self._attrs)))
+            raise AttributeError('%s not in %s!'%(name, list(self._attrs)))
+
+    def _coordinate(self, name):
+        if name not in self._coords:
+            for path in ('Grid/'+name, name):
+                if path in self.layer:
+                    self._coords[name]= self.layer[path][:]
+                    break
+            else:
+                raise AttributeError('%s not in %s!'%(name, list(self._attrs)))
+
+        return self._coords[name]
+
+def readCube(files, bbox, var='Grid/precipitationCal', out=None, processes=None, rdcc_nbytes=None,
+             start=None, end=None, months=None):
+    '''
+    Read a (time, lat, lon) cube of a region from many IMERG HDF5 files. The bbox
+    is converted to index ranges once from the first file and only that hyperslab
+    is read from every file.
+
+    Inputs:
+    ---------------
+    :files - list of str; .HDF5 files sharing one grid, in time order, or a
+             geoPackage.store.Store whose early run is read instead (var and the
+             reading options do not apply to a store)
+    :bbox - tuple; (xmin, xmax, ymin, ymax) in degrees, cells whose centers fall inside are kept
+    :var - str; dataset path, stored as (time, lon, lat) or (lon, lat)
+    :out - str or array; .npy path to memory-map the cube to disk, or a preallocated
+           array of shape (time, lat, lon); None allocates in memory
+    :processes - int; read the files in this many worker processes, each writing its
+                 time steps into the memory-mapped cube; requires out as a .npy path.
+                 HDF5 serializes reads within a process, so threads would not help
+    :rdcc_nbytes - int; HDF5 chunk cache size, see H5
+    :start, end, months - only keep time steps in [start, end) and in these months,
+                          files are dated by the timestamp of their name
+
+    Outputs:
+    ---------------
+    :cube - float32 array (or memmap) of shape (time, lat, lon), negative values
+            (no data) set to nan, for files and stores alike
+    :lats, lons - 1-D coordinate arrays of the cube
+    '''
+    if hasattr(files, 'cube'):
+        return files.cube(bbox, start=start, end=end, months=months, out=out)
+    if processes and not isinstance(out, str):
+        raise ValueError('processes requires out as a .npy path, workers write into its memory map')
+    if start is not None or end is not None or months is not None:
+        start, end= _dateKey(start), _dateKey(end)
+        files= [filename for filename in files
+                if timestampKey(filename) is not None and selectKey(timestampKey(filename), start, end, months)]
+    if not files:
+        raise ValueError('no files selected between %s and %s'%(start, end))
+    with H5(files[0]) as first:
+        lats, lons= first.lats, first.lons
+    window= _bboxWindow(lats, lons, bbox)
+    lat0, lat1, lon0, lon1= window
+    cube= _cubeOut(out, (len(files), lat1-lat0, lon1-lon0))
+
+    if processes:
+        cube.flush()
+        steps= [(int(t[0]), int(t[-1])+1) for t in np.array_split(np.arange(len(files)), processes) if len(t)]
+        with ProcessPoolExecutor(processes) as executor:
+            futures= [executor.submit(_readCubeSteps, files[t0:t1], t0, var, out, window, rdcc_nbytes)
+                      for t0, t1 in steps]
+            for future in futures:
+                future.result()
+        # the workers wrote through their own maps
+        cube= np.load(out, mmap_mode='r+')
+    else:
+        _readCubeSteps(files, 0, var, cube, window, rdcc_nbytes)
+    if isinstance(cube, np.memmap):
+        cube.flush()
+
+    return cube, lats[lat0:lat1], lons[lon0:lon1]
+
+def _bboxWindow(lats, lons, bbox):
+    '''(lat0, lat1, lon0, lon1) index ranges of the cells whose centers fall inside bbox'''
+    xmin, xmax, ymin, ymax= bbox
+    lat_idx= np.flatnonzero((lats>=ymin) & (lats<=ymax))
+    lon_idx= np.flatnonzero((lons>=xmin) & (lons<=xmax))
+    if len(lat_idx)==0 or len(lon_idx)==0:
+        raise ValueError('bbox %s does not cover any grid cell'%(str(bbox)))
+
+    return int(lat_idx.min()), int(lat_idx.max())+1, int(lon_idx.min()), int(lon_idx.max())+1
+
+def _cubeOut(out, shape):
+    '''float32 cube of shape: in memory (None), memory-mapped to a .npy path, or a preallocated array'''
+    if out is None:
+        return np.empty(shape, dtype=np.float32)
+    if isinstance(out, str):
+        return np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=shape)
+    if out.shape!=tuple(shape):
+        raise ValueError('expected out of shape %s, but got %s'%(str(tuple(shape)), str(out.shape)))
+
+    return out
+
+def _readCubeSteps(files, t0, var, cube, window, rdcc_nbytes=None):
+    '''read the bbox window of files into cube[t0:t0+len(files)]; cube may be a .npy path'''
+    lat0, lat1, lon0, lon1= window
+    if isinstance(cube, str):
+        cube= np.load(cube, mmap_mode='r+')
+    buffer= np.empty((lon1-lon0, lat1-lat0), dtype=np.float32)
+    for t, filename in enumerate(files):
+        with H5(filename, rdcc_nbytes=rdcc_nbytes) as h5:
+            dataset= h5[var].dataset
+            selection= np.s_[0, lon0:lon1, lat0:lat1] if dataset.ndim==3 else np.s_[lon0:lon1, lat0:lat1]
+            dataset.read_direct(buffer, source_sel=selection)
+        buffer[buffer<0]= np.nan
+        cube[t0+t]= buffer.T
+    if isinstance(cube, np.memmap):
+        cube.flush()
+
+# ENVI 'data type' codes
+_ENVI_DTYPES= {1: np.uint8, 2: np.int16, 3: np.int32, 4: np.float32, 5: np.float64, 6: np.complex64,
+               9: np.complex128, 12: np.uint16, 13: np.uint32, 14: np.int64, 15: np.uint64}
+
+def toENVI(src, dst=None, interleave='BSQ'):
+    '''
+    One-shot conversion of a GDAL raster (e.g. a compressed GeoTIFF) into an
+    uncompressed ENVI raster: a flat binary plus a .hdr sidecar holding shape,
+    data type, byte order, georeferencing and nodata, which Raster memory-maps.
+
+    Inputs:
+    ------------------
+    :src - str or geoPackage.io.Raster; source raster
+    :dst - str; output binary path, by default the source path with extension .img
+    :interleave - str; 'BSQ' (band after band, contiguous 2-D bands), 'BIL' or 'BIP'
+
+    Outputs:
+    ------------------
+    :raster - geoPackage.io.Raster on dst, backed by a np.memmap
+    '''
+    if interleave.upper() not in ('BSQ', 'BIL', 'BIP'):
+        raise ValueError('interleave %s not in %s'%(interleave, ['BSQ', 'BIL', 'BIP']))
+    if isinstance(src, Raster):
+        src_ds, src_name= src.layer, src.filename
+    else:
+        src_ds, src_name= src, src
+    if dst is None:
+        if not src_name:
+            raise ValueError('dst is required for in-memory rasters')
+        dst= os.path.splitext(src_name)[0]+'.img'
+    ds= gdal.Translate(dst, src_ds, format='ENVI', creationOptions=['INTERLEAVE=%s'%interleave.upper()])
+    if ds is None:
+        raise ValueError('conversion of %s to ENVI failed: %s'%(src_name, gdal.GetLastErrorMsg()))
+    ds= None
+
+    return Raster(dst, memmap=True)
+
+def _headerENVI(filename):
+    '''fields of the .hdr sidecar of an ENVI binary as a dict of strings'''
+    for header in (os.path.splitext(filename)[0]+'.hdr', filename+'.hdr'):
+        if os.path.exists(header):
+            break
+    else:
+        raise FileNotFoundError('no ENVI header found for %s'%filename)
+    with open(header) as f:
+        text= f.read()
+    fields= {}
+    # values may be {...} blocks spanning several lines
+    for match in re.finditer(r'^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)', text, flags=re.M):
+        fields[match.group(1).lower()]= match.group(2).strip()
+
+    return fields
+
+def _memmapENVI(filename):
+    '''
+    read-only np.memmap of an ENVI binary, of shape (rows, cols) for one band and
+    (bands, rows, cols) otherwise, as returned by gdal ReadAsArray
+    '''
+    fields= _headerENVI(filename)
+    samples, lines, bands= int(fields['samples']), int(fields['lines']), int(fields.get('bands', 1))
+    code= int(fields['data type'])
+    if code not in _ENVI_DTYPES:
+        raise ValueError('ENVI data type %d of %s is not supported'%(code, filename))
+    dtype= np.dtype(_ENVI_DTYPES[code]).newbyteorder('>' if fields.get('byte order', '0')=='1' else '<')
+    offset= int(fields.get('header offset', 0))
+    interleave= fields.get('interleave', 'bsq').lower()
+    shape= {'bsq': (bands, lines, samples), 'bil': (lines, bands, samples), 'bip': (lines, samples, bands)}[interleave]
+    if os.path.getsize(filename)<offset+dtype.itemsize*bands*lines*samples:
+        raise ValueError('%s is smaller than its ENVI header %s describes'%(filename, str(shape)))
+    arr= np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+    # views, no copy, in (bands, rows, cols) order
+    if interleave=='bil':
+        arr= arr.transpose(1, 0, 2)
+    elif interleave=='bip':
+        arr= arr.transpose(2, 0, 1)
+
+    return arr[0] if bands==1 else arr
+
+def _creationOptions(dtype, tiled=True, blocksize=256, compress='DEFLATE', predictor=None, bigtiff='IF_SAFER'):
+    '''
+    GTiff creation options
+
+    Inputs:
+    ---------------
+    :dtype - numpy dtype of the data, picks the predictor when predictor is None
+    :tiled - bool; write tiles instead of strips
+    :blocksize - int; tile width and height
+    :compress - str; 'DEFLATE', 'ZSTD', 'LZW', ... None writes uncompressed
+    :predictor - int; 1 none, 2 horizontal differencing, 3 floating point
+    :bigtiff - str; 'YES', 'NO', 'IF_NEEDED' or 'IF_SAFER'
+    '''
+    options= ['BIGTIFF=%s'%bigtiff]
+    if tiled:
+        options+= ['TILED=YES', 'BLOCKXSIZE=%d'%blocksize, 'BLOCKYSIZE=%d'%blocksize]
+    if compress is not None:
+        options.append('COMPRESS=%s'%compress.upper())
+        if predictor is None:
+            predictor= 3 if np.dtype(dtype).kind=='f' else 2
+        options.append('PREDICTOR=%d'%predictor)
+
+    return options
+
+def _toWkt(crs):
+    '''WKT of any crs definition understood by GDAL, e.g. 'EPSG:4326' or WKT itself'''
+    if not crs:
+        return ''
+    srs= osr.SpatialReference()
+    srs.SetFromUserInput(crs)
+
+    return srs.ExportToWkt()
+
 
 class WriteFile:
-    def __init__(self, field):
+    def __init__(self, field, geotransform=None, crs='EPSG:4326', template=None, nodata=None):
         '''
         Inputs:
         ---------------
-        :field - numpy array with shape (rows, cols)
+        :field - numpy array with shape (rows, cols) or (bands, rows, cols)
+        :geotransform - tuple; GDAL geotransform of the field
+        :crs - str; projection as WKT or 'EPSG:xxxx'
+        :template - geoPackage.io.Raster; take geotransform and crs from this raster
+        :nodata - nodata value set on every band
+
+        Without geotransform or template the grid is taken from 'test_sample.HDF5'
+        in the working directory.
         '''
         self.field= field
-        self.sampleFile= ReadFile('test_sample.HDF5').layer
+        self.nodata= nodata
+        if template is not None:
+            geotransform, crs= template.geotransform, template.crs
+        self.geotransform= geotransform
+        self.crs= crs
 
-    def write(self, dst):
+    def write(self, dst, tiled=True, blocksize=256, compress='DEFLATE', predictor=None, bigtiff='IF_SAFER',
+              overviews=None, resampling='AVERAGE', cog=False):
         '''
         Inputs:
         ---------------
         :dst - str, file path to store new file
+        :tiled, blocksize, compress, predictor, bigtiff - GTiff creation options, see _creationOptions
+        :overviews - list of int; overview factors to build, e.g. [2, 4, 8]
+        :resampling - str; overview resampling
+        :cog - bool; write a Cloud Optimized GeoTIFF (GDAL >= 3.1); the COG driver builds
+               its own overviews, so overviews must be None, and tiled is implied
         '''
-        lats= self.sampleFile.lats
-        lons= self.sampleFile.lons
+        if cog and overviews:
+            raise ValueError('overviews are built by the COG driver, pass overviews=None with cog=True')
+        if self.geotransform is None:
+            self.geotransform= self._sampleGeotransform()
+        field= self.field if self.field.ndim==3 else self.field[np.newaxis]
+        nbands, rows, cols= field.shape
+        dtype= gdal_array.NumericTypeCodeToGDALTypeCode(field.dtype.type)
+
+        if cog:
+            outdata= gdal.GetDriverByName('MEM').Create('', cols, rows, nbands, dtype)
+        else:
+            driver = gdal.GetDriverByName('GTiff')
+            outdata = driver.Create(dst, cols, rows, nbands, dtype,
+                                    options=_creationOptions(field.dtype, tiled, blocksize, compress, predictor, bigtiff))
+        outdata.SetGeoTransform(tuple(self.geotransform))
+        outdata.SetProjection(_toWkt(self.crs))
+        for i in range(nbands):
+            band= outdata.GetRasterBand(i+1)
+            band.WriteArray(field[i])
+            if self.nodata is not None:
+                band.SetNoDataValue(self.nodata)
+        if cog:
+            options= ['BLOCKSIZE=%d'%blocksize, 'BIGTIFF=%s'%bigtiff, 'RESAMPLING=%s'%resampling]
+            # the COG driver compresses with LZW unless told otherwise
+            if compress is None:
+                options.append('COMPRESS=NONE')
+            else:
+                options.append('COMPRESS=%s'%compress.upper())
+                options.append('PREDICTOR=%s'%{None: 'YES', 1: 'NO', 2: 'STANDARD', 3: 'FLOATING_POINT'}[predictor])
+            gdal.Translate(dst, outdata, format='COG', creationOptions=options)
+        elif overviews:
+            outdata.BuildOverviews(resampling, list(overviews))
+        outdata.FlushCache()
+        outdata= None
+
+    def _sampleGeotransform(self):
+        with H5('test_sample.HDF5') as sampleFile:
+            lats= sampleFile.lats
+            lons= sampleFile.lons
         pixelHeight= lats[1]- lats[0]
         pixelWidth= lons[1]- lons[0]
-        rows, cols= self.field.shape
-        originX= lons[0]
-        originY= lons[1]
-
-        driver = gdal.GetDriverByName('GTiff')
-        outdata = driver.Create(dst, cols, rows, 1, gdal.GDT_Float32)
-        outdata.SetGeoTransform((originX, pixelWidth, 0, originY, 0, pixelHeight))
-        outdata.SetProjection("EPSG:4326")
-        outdata.GetRasterBand(1).WriteArray(self.field)
+        # coordinates are cell centers
+        originX= lons[0]- pixelWidth/2.
+        originY= lats[0]- pixelHeight/2.
+
+        return (originX, pixelWidth, 0, originY, 0, pixelHeight)
+
+
+class BlockWriter:
+    '''
+    Streaming, block-wise GeoTIFF writer for outputs larger than memory.
+
+        with BlockWriter(dst, (rows, cols), geotransform, crs) as writer:
+            for arr, xoff, yoff in blocks:
+                writer.write_block(arr, xoff, yoff)
+
+    Inputs:
+    ---------------
+    :dst - str; output file path
+    :shape - tuple; (rows, cols)
+    :geotransform - tuple; GDAL geotransform, or take it from template
+    :crs - str; projection as WKT or 'EPSG:xxxx'
+    :bands - int; number of bands, e.g. one per time step
+    :dtype - numpy dtype of the output
+    :nodata - nodata value set on every band
+    :template - geoPackage.io.Raster; take shape, geotransform and crs from this raster
+    :threaded - bool; write blocks from a background thread so compute and disk I/O overlap
+    :queue_size - int; blocks waiting for the background writer before write_block blocks
+    :overviews - list of int; overview factors built on close
+    :options - GTiff creation options (tiled, blocksize, compress, predictor, bigtiff), see _creationOptions
+    '''
+    def __init__(self, dst, shape=None, geotransform=None, crs='EPSG:4326', bands=1, dtype=np.float32, nodata=None,
+                 template=None, threaded=False, queue_size=8, overviews=None, **options):
+        if template is not None:
+            shape, geotransform, crs= template.shape, template.geotransform, template.crs
+        if shape is None or geotransform is None:
+            raise ValueError('shape and geotransform (or a template raster) are required')
+        self.filename= dst
+        self.shape= tuple(shape)
+        self.bands= bands
+        self.dtype= np.dtype(dtype)
+        self.overviews= overviews
+        rows, cols= self.shape
+        driver= gdal.GetDriverByName('GTiff')
+        self.layer= driver.Create(dst, cols, rows, bands, gdal_array.NumericTypeCodeToGDALTypeCode(self.dtype.type),
+                                  options=_creationOptions(self.dtype, **options))
+        self.layer.SetGeoTransform(tuple(geotransform))
+        self.layer.SetProjection(_toWkt(crs))
+        if nodata is not None:
+            for i in range(bands):
+                self.layer.GetRasterBand(i+1).SetNoDataValue(nodata)
+        self._queue= None
+        self._thread= None
+        self._error= None
+        if threaded:
+            self._queue= queue.Queue(maxsize=queue_size)
+            self._thread= threading.Thread(target=self._drain, daemon=True)
+            self._thread.start()
+
+    @property
+    def blocksize(self):
+        '''(xsize, ysize) natural block of the output, write blocks aligned to it'''
+        return tuple(self.layer.GetRasterBand(1).GetBlockSize())
+
+    def write_block(self, array, xoff, yoff, band=None):
+        '''
+        Inputs:
+        ---------------
+        :array - (rows, cols) array, or (bands, rows, cols) to write all bands at once
+        :xoff, yoff - int; pixel offset of the block
+        :band - int; 1-based band index of a 2-D block, by default 1
+        '''
+        if self._error is not None:
+            raise self._error
+        # the background writer needs its own copy, callers may reuse their buffer
+        array= np.array(array, dtype=self.dtype) if self._queue is not None else np.asarray(array, dtype=self.dtype)
+        rows, cols= array.shape[-2:]
+        if xoff<0 or yoff<0 or xoff+cols>self.shape[1] or yoff+rows>self.shape[0]:
+            raise ValueError('block (%d, %d, %d, %d) out of output bounds %s'%(xoff, yoff, cols, rows, str(self.shape)))
+        if array.ndim==3:
+            if array.shape[0]!=self.bands:
+                raise ValueError('block has %d bands, but the output has %d'%(array.shape[0], self.bands))
+            items= [(array[i], xoff, yoff, i+1) for i in range(array.shape[0])]
+        else:
+            band= 1 if band is None else band
+            if not 1<=band<=self.bands:
+                raise ValueError('band %d out of range 1-%d'%(band, self.bands))
+            items= [(array, xoff, yoff, band)]
+        for item in items:
+            if self._queue is not None:
+                self._queue.put(item)
+            else:
+                self._write(*item)
+
+    def close(self):
+        if self.layer is None:
+            return
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is None and self.overviews:
+            self.layer.BuildOverviews('AVERAGE', list(self.overviews))
+        self.layer.FlushCache()
+        self.layer= None
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write(self, array, xoff, yoff, band):
+        self.layer.GetRasterBand(band).WriteArray(array, xoff, yoff)
+
+    def _drain(self):
+        while True:
+            item= self._queue.get()
+            if item is None:
+                break
+            if self._error is None:
+                try:
+                    self._write(*item)
+                except Exception as error:
+                    self._error= error
+
+
+registerReader('hdf5', 'layer', _isHDF5, H5)
+registerReader('netcdf', 'raster', _isNetCDF, _openNetCDF)
+registerReader('gtiff', 'raster', _isTIFF, Raster)
+registerReader('gpkg', 'vector', _isGeoPackage, Vector)
+registerReader('shapefile', 'vector', _isShapefile, Vector)
+registerReader('ogr', 'vector', _isGDALVector, Vector)
+registerReader('gdal', 'raster', _isGDALRaster, Raster)
@@ -1,9 +1,19 @@
-from osgeo import gdal, ogr
+from osgeo import gdal, ogr, osr
 from affine import Affine
 import numpy as np
-from .io import ReadFile, Raster, Vector
-import geopandas as gpd
-import os
+import pandas as pd
+from .io import Raster, Vector
+from scipy import ndimage
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import warnings
+import weakref
+
+# label grids of rasterized vectors, {vector: {(geotransform, shape, all_touched): (labels, overlaps)}}
+_LABEL_CACHE= weakref.WeakKeyDictionary()
+# /vsimem cutline files of in-memory or pruned vectors, {vector: path}
+_CUTLINES= weakref.WeakKeyDictionary()
 
 
 class Geoprocess(object):
@@ -15,176 +25,754 @@ class Geoprocess(object):
         Inputs:
         -----------------
         :extent - tuple; (xmin, xmax, ymin, ymax)
-        :
+        :dst - str; output file path, None keeps the result in memory
+        :nodata - nodata value of the output
 
         Output:
         -----------------
-        NorasterCropedne - gdal.Dataset object
+        :rasterCroped - geoPackage.io.Raster object
         '''
-        if dst is None:
-            if not os.path.exists('temp'):
-                os.mkdir('temp')
-            dst= 'temp/temp_file.tif'
         self._validateType(self.raster, 'raster')
         xmin, xmax, ymin, ymax= extent
-        ds= gdal.Translate(dst, self.raster.filename, projWin=[xmin, ymin, xmax, ymax], noData=nodata, outputSRS= self.raster.geotransform)
-        rasterCroped= ReadFile(dst).raster
-        if os.path.exists('temp/temp_file.tif'):
-            os.system('rm -r temp')
+        window= self._extentWindow(extent)
+        if dst is None and window is not None:
+            # north-up raster and extent inside it: plain array slicing
+            xoff, yoff, xsize, ysize= window
+            Xori, Xres, _, Yori, _, Yres= self.raster.geotransform
+            # copy so the clip does not alias the source's cached array
+            arr= np.array(self.raster.read_window(xoff, yoff, xsize, ysize))
+
+            return Raster.fromArray(arr, (Xori+xoff*Xres, Xres, 0, Yori+yoff*Yres, 0, Yres),
+                                    crs=self.raster.crs, nodata=nodata)
+        if dst is None:
+            ds= gdal.Translate('', self.raster.layer, format='MEM', projWin=[xmin, ymax, xmax, ymin], noData=nodata)
+
+            return Raster('', layer=ds)
+        ds= gdal.Translate(dst, self.raster.layer, projWin=[xmin, ymax, xmax, ymin], noData=nodata)
+        ds= None
 
-        return rasterCroped
+        return Raster(dst)
 
 
     def rasterClipByMask(self, mask, dst=None, nodata=-9999):
         '''
         Inputs:
         -----------------
-        :mask - geopandas object
-        :dst -
+        :mask - geoPackage.io.Vector object
+        :dst - str; output file path, None keeps the result in memory
+        :nodata - nodata value of the output
 
         Output:
         -----------------
-        :rasterCroped - gdal object
+        :rasterCroped - geoPackage.io.Raster object
         '''
         self._validateType(self.raster, 'raster')
         self._validateType(mask, 'vector')
-        # self._validateCRS(self.raster, mask)
+        cutline= self._cutline(self._alignCRS(mask))
         if dst is None:
-            if not os.path.exists('temp'): os.mkdir('temp')
-            out= 'temp/temp_file.tif'
-        result= gdal.Warp(out, self.raster.filename, cutlineDSName= mask.filename, dstNodata=nodata)
-        rasterCroped= ReadFile(out).raster
-        if os.path.exists('temp/temp_file.tif'):
-            os.system('rm -r temp')
+            ds= gdal.Warp('', self.raster.layer, format='MEM', cutlineDSName= cutline, dstNodata=nodata)
+
+            return Raster('', layer=ds)
+        ds= gdal.Warp(dst, self.raster.layer, cutlineDSName= cutline, dstNodata=nodata)
+        ds= None
+
+        return Raster(dst)
+
+    def zonalStats(self, vector, metrics=('count', 'sum', 'mean', 'min', 'max'), band=1, all_touched=False, nodata=None):
+        '''
+        Zonal statistics of all polygons at once. Polygons are rasterized into a
+        label grid (cached per vector and grid) and reduced with bincount and a
+        single sort, without looping over polygons. Nested or overlapping polygons
+        (e.g. upstream and downstream basins) each get all of their pixels.
+
+        Inputs:
+        -----------------
+        :vector - geoPackage.io.Vector object of polygons
+        :metrics - list of str; 'count', 'sum', 'mean', 'std', 'min', 'max', 'median'
+                   or percentiles as 'p<q>', e.g. 'p90'
+        :band - int; 1-based band index
+        :all_touched - bool; burn every pixel touched by a polygon, not only pixel centers
+        :nodata - value excluded from the statistics, by default the raster nodata;
+                  nan is always excluded
+
+        Output:
+        -----------------
+        :stats - pandas.DataFrame indexed by feature, one column per metric
+        '''
+        self._validateType(self.raster, 'raster')
+        self._validateType(vector, 'vector')
+        for metric in metrics:
+            if metric not in ('count', 'sum', 'mean', 'std', 'min', 'max', 'median') and not metric.startswith('p'):
+                raise ValueError('metric %s not supported'%metric)
+        rows, cols= self.raster.shape
+        nodata= self.raster.nodata if nodata is None else nodata
+        vector= self._alignCRS(vector)
+        labels, overlaps= self._labelGrid(vector, all_touched)
+        arr= self.raster.read_window(0, 0, cols, rows, band=band)
+        labels, values= labels.ravel(), arr.ravel()
+        if overlaps:
+            # pixels shared by several features are counted once per feature
+            labels= np.concatenate([labels]+ [np.full(inside.sum(), i+1, dtype=labels.dtype) for i, (_, inside) in overlaps.items()])
+            values= np.concatenate([values]+ [arr[sl][inside] for sl, inside in overlaps.values()])
+        valid= labels>0
+        if values.dtype.kind=='f':
+            valid&= ~np.isnan(values)
+        if nodata is not None:
+            valid&= values!=nodata
+        labels= labels[valid]
+        values= values[valid].astype(np.float64)
+        nzones= len(vector.layer)
 
-        return rasterCroped
+        count= np.bincount(labels, minlength=nzones+1)[1:]
+        empty= count==0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total= np.bincount(labels, weights=values, minlength=nzones+1)[1:]
+            mean= np.where(empty, np.nan, total/count)
+        results= {}
+        sorted_values= None
+        for metric in metrics:
+            if metric=='count':
+                results[metric]= count
+            elif metric=='sum':
+                results[metric]= total
+            elif metric=='mean':
+                results[metric]= mean
+            elif metric=='std':
+                squares= np.bincount(labels, weights=values**2, minlength=nzones+1)[1:]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    results[metric]= np.sqrt(np.maximum(squares/count- mean**2, 0))
+            else:
+                if sorted_values is None:
+                    # values sorted by zone, then by value
+                    sorted_values= values[np.lexsort((values, labels))]
+                    starts= np.concatenate([[0], np.cumsum(count)[:-1]])
+                if metric=='min':
+                    q= 0.
+                elif metric=='max':
+                    q= 100.
+                elif metric=='median':
+                    q= 50.
+                else:
+                    q= float(metric[1:])
+                results[metric]= self._sortedPercentile(sorted_values, starts, count, q)
+
+        return pd.DataFrame(results, index=vector.layer.index)
+
+    def _sortedPercentile(self, sorted_values, starts, count, q):
+        '''linearly interpolated percentile q of each group of a grouped, sorted array'''
+        if len(sorted_values)==0:
+            return np.full(len(count), np.nan)
+        pos= starts+ q/100.* np.maximum(count-1, 0)
+        lo= np.minimum(np.floor(pos).astype(np.int64), len(sorted_values)-1)
+        hi= np.minimum(np.ceil(pos).astype(np.int64), len(sorted_values)-1)
+        frac= pos- np.floor(pos)
+        value= sorted_values[lo]*(1-frac)+ sorted_values[hi]*frac
+
+        return np.where(count==0, np.nan, value)
+
+    def rasterClipByMasks(self, mask, nodata=-9999, output='array', all_touched=False, threads=None):
+        '''
+        Clip the raster against every polygon of a vector. All polygons are
+        rasterized once into a label grid and the source is read once, instead
+        of one warp per polygon.
+
+        Inputs:
+        -----------------
+        :mask - geoPackage.io.Vector object of polygons
+        :nodata - value of pixels outside the polygon
+        :output - str; 'array' yields the clipped array over the polygon bounding box,
+                  'raster' yields an in-memory geoPackage.io.Raster, 'values' yields
+                  the 1-D array of pixel values inside the polygon
+        :all_touched - bool; burn every pixel touched by a polygon, not only pixel centers
+        :threads - int; clip features in a thread pool
+
+        Output:
+        -----------------
+        :generator of (feature index, clipped) in feature order; clipped is None
+         for features covering no pixel center. Nested or overlapping polygons
+         each keep all of their pixels.
+        '''
+        self._validateType(self.raster, 'raster')
+        self._validateType(mask, 'vector')
+        if output not in ('array', 'raster', 'values'):
+            raise ValueError('output %s not in %s'%(output, ['array', 'raster', 'values']))
+        mask= self._alignCRS(mask)
+        labels, overlaps= self._labelGrid(mask, all_touched)
+        arr= self.raster.array
+        Xori, Xres, Xskew, Yori, Yskew, Yres= self.raster.geotransform
+        slices= ndimage.find_objects(labels, max_label=len(mask.layer))
+
+        def clip(i):
+            if i in overlaps:
+                sl, inside= overlaps[i]
+            else:
+                sl= slices[i]
+                if sl is None:
+                    return None
+                inside= labels[sl]==i+1
+            sub= arr[(Ellipsis,)+sl]
+            if output=='values':
+                return sub[..., inside]
+            clipped= np.where(inside, sub, nodata)
+            if output=='array':
+                return clipped
+            yoff, xoff= sl[0].start, sl[1].start
+            geotrans= (Xori+xoff*Xres+yoff*Xskew, Xres, Xskew, Yori+xoff*Yskew+yoff*Yres, Yskew, Yres)
+
+            return Raster.fromArray(clipped, geotrans, crs=self.raster.crs, nodata=nodata)
+
+        index= list(mask.layer.index)
+        if threads is None:
+            for i in range(len(index)):
+                yield index[i], clip(i)
+        else:
+            with ThreadPoolExecutor(threads) as executor:
+                for i, clipped in enumerate(executor.map(clip, range(len(index)))):
+                    yield index[i], clipped
+
+    def _labelGrid(self, vector, all_touched=False):
+        '''
+        Rasterize every feature of a vector onto the raster grid. A pixel of the
+        label grid holds one feature only, so features sharing pixels with others
+        (nested or overlapping polygons) are left out of it and rasterized one by
+        one inside their bounding-box windows.
+
+        Outputs:
+        -----------------
+        :labels - int32 array of shape (rows, cols); 0 outside all features,
+                  i+1 inside the i-th feature
+        :overlaps - dict {i: (window slices, boolean mask of the window)} of the
+                    features left out of labels and covering at least one pixel
+        '''
+        key= (tuple(self.raster.geotransform), tuple(self.raster.shape), bool(all_touched))
+        cache= _LABEL_CACHE.setdefault(vector, {})
+        if key in cache:
+            return cache[key]
+        rows, cols= self.raster.shape
+        geometries= vector.layer.geometry.values
+        # only features touching the raster are burnt
+        index= np.array([i for i in vector.query(self.raster)
+                         if geometries[i] is not None and not geometries[i].is_empty], dtype=np.int64)
+        overlapping= self._overlapping(geometries[index], all_touched)
+        labels= self._rasterize(index[~overlapping], geometries, (0, 0, cols, rows), all_touched)
+        overlaps= {}
+        for i in index[overlapping]:
+            window= self._geometryWindow(geometries[i])
+            if window is None:
+                continue
+            xoff, yoff, xsize, ysize= window
+            inside= self._rasterize([i], geometries, window, all_touched)==i+1
+            found= ndimage.find_objects(inside.astype(np.int8))
+            if not found:
+                continue
+            # tight to the burnt pixels, like the slices of the label grid
+            rsl, csl= found[0]
+            overlaps[int(i)]= ((slice(yoff+rsl.start, yoff+rsl.stop), slice(xoff+csl.start, xoff+csl.stop)),
+                               inside[rsl, csl])
+        cache[key]= labels, overlaps
+
+        return cache[key]
+
+    def _overlapping(self, geometries, all_touched=False):
+        '''
+        boolean mask of the geometries that may share pixels with another one: pairs
+        overlapping by some area, or with all_touched closer than a pixel diagonal
+        '''
+        overlapping= np.zeros(len(geometries), dtype=bool)
+        if len(geometries)<2:
+            return overlapping
+        tree= shapely.STRtree(geometries)
+        if all_touched:
+            Xori, Xres, Xskew, Yori, Yskew, Yres= self.raster.geotransform
+            left, right= tree.query(geometries, predicate='dwithin',
+                                    distance=np.hypot(abs(Xres)+abs(Xskew), abs(Yres)+abs(Yskew)))
+        else:
+            left, right= tree.query(geometries, predicate='intersects')
+        left, right= left[left<right], right[left<right]
+        if not all_touched:
+            # neighbours sharing only a border share no pixel center
+            area= shapely.area(shapely.intersection(geometries[left], geometries[right]))
+            left, right= left[area>0], right[area>0]
+        overlapping[left]= True
+        overlapping[right]= True
+
+        return overlapping
+
+    def _geometryWindow(self, geometry):
+        '''pixel window (xoff, yoff, xsize, ysize) of the bounding box of a geometry, None outside the raster'''
+        xmin, ymin, xmax, ymax= geometry.bounds
+        cols, rows= self._pixelCoords([xmin, xmax, xmin, xmax], [ymin, ymin, ymax, ymax])
+        nrows, ncols= self.raster.shape
+        # one pixel margin for pixels only touched by the geometry
+        x0, x1= max(int(np.floor(cols.min()))-1, 0), min(int(np.ceil(cols.max()))+1, ncols)
+        y0, y1= max(int(np.floor(rows.min()))-1, 0), min(int(np.ceil(rows.max()))+1, nrows)
+        if x1<=x0 or y1<=y0:
+            return None
+
+        return x0, y0, x1-x0, y1-y0
+
+    def _rasterize(self, index, geometries, window, all_touched=False):
+        '''burn geometries[i] with value i+1 into an int32 grid covering a pixel window of the raster'''
+        xoff, yoff, xsize, ysize= window
+        Xori, Xres, Xskew, Yori, Yskew, Yres= self.raster.geotransform
+        source= ogr.GetDriverByName('Memory').CreateDataSource('')
+        layer= source.CreateLayer('labels', geom_type=ogr.wkbUnknown)
+        layer.CreateField(ogr.FieldDefn('_label', ogr.OFTInteger))
+        for i in index:
+            feature= ogr.Feature(layer.GetLayerDefn())
+            feature.SetField('_label', int(i)+1)
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(geometries[i].wkb))
+            layer.CreateFeature(feature)
+        ds= gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, gdal.GDT_Int32)
+        ds.SetGeoTransform((Xori+xoff*Xres+yoff*Xskew, Xres, Xskew, Yori+xoff*Yskew+yoff*Yres, Yskew, Yres))
+        options= ['ATTRIBUTE=_label']
+        if all_touched:
+            options.append('ALL_TOUCHED=TRUE')
+        gdal.RasterizeLayer(ds, [1], layer, options=options)
+
+        return ds.GetRasterBand(1).ReadAsArray()
+
+    def _extentWindow(self, extent):
+        '''
+        pixel window (xoff, yoff, xsize, ysize) of an extent on a north-up raster,
+        None if the raster is rotated or the extent is not inside the raster
+        '''
+        Xori, Xres, Xskew, Yori, Yskew, Yres= self.raster.geotransform
+        if Xskew!=0 or Yskew!=0 or Xres<=0 or Yres>=0:
+            return None
+        xmin, xmax, ymin, ymax= extent
+        rows, cols= self.raster.shape
+        # snap like gdal.Translate projWin, so both paths return the same pixels
+        x0= int(np.floor((xmin-Xori)/Xres+0.001))
+        y0= int(np.floor((ymax-Yori)/Yres+0.001))
+        xsize= int(np.floor((xmax-xmin)/Xres+0.5))
+        ysize= int(np.floor((ymin-ymax)/Yres+0.5))
+        if x0<0 or y0<0 or x0+xsize>cols or y0+ysize>rows or xsize<=0 or ysize<=0:
+            return None
+
+        return x0, y0, xsize, ysize
 
     def pointExtract(self, geopnts):
         '''
         Inputs:
         ------------------
-        :raster - gdal object
-        :geopnts - geopandas vector object
+        :geopnts - geoPackage.io.Vector object of points
+
+        Outputs:
+        ------------------
+        :values - dict; {'lons': [], 'lats': [], 'samples': []}
+        '''
+        values= self.pointSample(geopnts)
+
+        return {key: list(value) for key, value in values.items()}
+
+    def pointSample(self, geopnts, method='nearest', band=None, frame=False, tiled=False):
         '''
+        Batched point sampling: all points are converted to pixel indices at once
+        and only the raster window covering the points is read, or with tiled=True
+        only the raster blocks that contain points.
 
+        Inputs:
+        ------------------
+        :geopnts - geoPackage.io.Vector object of points
+        :method - str; 'nearest' or 'bilinear'
+        :band - int; 1-based band index, None samples all bands
+        :frame - bool; return a pandas.DataFrame instead of a dict of arrays
+        :tiled - bool; read block by block the tiles holding points, found with the
+                 vector spatial index; for scattered points on large rasters, 'nearest' only
+
+        Outputs:
+        ------------------
+        :values - dict or DataFrame with columns lons, lats and samples (single band)
+                  or band_1 ... band_n (multi-band); points outside the raster or on
+                  nodata pixels are nan
+        '''
         self._validateType(self.raster, 'raster')
         self._validateType(geopnts, 'vector')
-        geotrans= self.raster.geotransform
-        forward_transform= Affine.from_gdal(*geotrans)
-        values= {'lats': [],
-                'lons': [],
-                'samples': []}
-        for i in range(len(geopnts.layer)):
-            # print(np.array(geopnts.layer.geometry[i]).squeeze())
-            geometry= np.array(geopnts.layer.geometry[i]).squeeze()
-            res = ~forward_transform* geometry
-            x,y = int(res[0]), int(res[1])
-            values['lats'].append(geometry[0])
-            values['lons'].append(geometry[1])
-            values['samples'].append(self._pointsampling(self.raster, x, y))
+        if method not in ('nearest', 'bilinear'):
+            raise ValueError('method %s not in %s'%(method, ['nearest', 'bilinear']))
+        lons= np.asarray(geopnts.layer.geometry.x, dtype=np.float64)
+        lats= np.asarray(geopnts.layer.geometry.y, dtype=np.float64)
+        geopnts= self._alignCRS(geopnts)
+        cols, rows= self._pixelCoords(geopnts.layer.geometry.x, geopnts.layer.geometry.y)
+        if tiled:
+            if method!='nearest':
+                raise ValueError('tiled sampling only supports the nearest method')
+            samples= self._sampleTiles(geopnts, cols, rows, band)
+        else:
+            samples= self._sampleArray(cols, rows, method, band)
+
+        values= {'lons': lons, 'lats': lats}
+        if samples.shape[1]==1:
+            values['samples']= samples[:,0]
+        else:
+            for i in range(samples.shape[1]):
+                values['band_%d'%(i+1)]= samples[:,i]
+        if frame:
+            return pd.DataFrame(values)
 
         return values
 
-    #TODO
-    def reshape(self, shape, dst=None, method='bilinear', proj='WGS84', noData=-9999):
+    def _pixelCoords(self, xs, ys):
+        '''fractional (col, row) pixel coordinates of world coordinates'''
+        inverse_transform= ~Affine.from_gdal(*self.raster.geotransform)
+        cols, rows= inverse_transform* (np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+
+        return np.asarray(cols), np.asarray(rows)
+
+    def _sampleArray(self, cols, rows, method='nearest', band=None):
+        '''
+        Inputs:
+        ------------------
+        :cols, rows - array; fractional pixel coordinates
+        :method - str; 'nearest' or 'bilinear'
+        :band - int; 1-based band index, None for all bands
+
+        Outputs:
+        ------------------
+        :samples - float array of shape (points, bands), nan outside the raster and on
+                   nodata; bilinear drops nodata neighbours and renormalizes the weights
+        '''
+        nrows, ncols= self.raster.shape
+        cols, rows, inside= self._insidePixels(cols, rows)
+        nbands= 1 if band is not None else self.raster.bands
+        samples= np.full((len(cols), nbands), np.nan, dtype=np.float64)
+        if not inside.any():
+            return samples
+
+        if method=='nearest':
+            icol= np.floor(cols[inside]).astype(np.int64)
+            irow= np.floor(rows[inside]).astype(np.int64)
+            x0, x1= icol.min(), icol.max()+1
+            y0, y1= irow.min(), irow.max()+1
+            block= self._maskNodata(self.raster.read_window(x0, y0, x1-x0, y1-y0, band=band))
+            samples[inside]= block[:, irow-y0, icol-x0].T
+        else:
+            # bilinear between the four surrounding pixel centers
+            fcol= cols[inside]- 0.5
+            frow= rows[inside]- 0.5
+            c0= np.clip(np.floor(fcol).astype(np.int64), 0, ncols-1)
+            r0= np.clip(np.floor(frow).astype(np.int64), 0, nrows-1)
+            c1= np.minimum(c0+1, ncols-1)
+            r1= np.minimum(r0+1, nrows-1)
+            dx= np.clip(fcol-c0, 0, 1)[:, np.newaxis]
+            dy= np.clip(frow-r0, 0, 1)[:, np.newaxis]
+            x0, x1= c0.min(), c1.max()+1
+            y0, y1= r0.min(), r1.max()+1
+            block= self._maskNodata(self.raster.read_window(x0, y0, x1-x0, y1-y0, band=band))
+            c0, c1, r0, r1= c0-x0, c1-x0, r0-y0, r1-y0
+            # (points, bands, 4) neighbours; missing ones are dropped and the weights renormalized
+            neighbours= np.stack([block[:, r0, c0].T, block[:, r0, c1].T, block[:, r1, c0].T, block[:, r1, c1].T], axis=-1)
+            weights= np.stack(np.broadcast_arrays((1-dx)*(1-dy), dx*(1-dy), (1-dx)*dy, dx*dy), axis=-1)
+            valid= ~np.isnan(neighbours)
+            total= np.where(valid, weights, 0).sum(axis=-1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                samples[inside]= np.where(valid, neighbours*weights, 0).sum(axis=-1)/total
+            samples[inside]= np.where(total>0, samples[inside], np.nan)
+
+        return samples
+
+    def _maskNodata(self, arr):
+        '''(bands, rows, cols) float64 copy of a window with the raster nodata set to nan'''
+        block= self._asBands(arr).astype(np.float64)
+        if self.raster.nodata is not None:
+            block[block==self.raster.nodata]= np.nan
+
+        return block
+
+    def _sampleTiles(self, geopnts, cols, rows, band=None):
+        '''nearest sampling reading only the raster blocks returned by geopnts.queryTiles'''
+        cols, rows, inside= self._insidePixels(cols, rows)
+        nbands= 1 if band is not None else self.raster.bands
+        samples= np.full((len(cols), nbands), np.nan, dtype=np.float64)
+        icol= np.floor(np.where(inside, cols, -1)).astype(np.int64)
+        irow= np.floor(np.where(inside, rows, -1)).astype(np.int64)
+        for window, ids in geopnts.queryTiles(self.raster).items():
+            # points on a tile border are returned for both tiles, keep the owning one
+            ids= ids[(icol[ids]>=window.xoff) & (icol[ids]<window.xoff+window.xsize) &
+                     (irow[ids]>=window.yoff) & (irow[ids]<window.yoff+window.ysize)]
+            if len(ids)==0:
+                continue
+            block= self._maskNodata(self.raster.read_window(*window, band=band))
+            samples[ids]= block[:, irow[ids]-window.yoff, icol[ids]-window.xoff].T
+
+        return samples
+
+    def pointExtractStack(self, geopnts, rasters, band=1, out=None):
         '''
+        Sample the same points over a stack of rasters (e.g. a time series) sharing
+        the geotransform and shape of self.raster. Pixel indices are computed once
+        and only the rows containing points are read from each file.
+
+        Inputs:
+        ------------------
+        :geopnts - geoPackage.io.Vector object of points
+        :rasters - list of raster paths, or a glob pattern sorted by name
+        :band - int; 1-based band index
+        :out - optional array-like of shape (points, len(rasters)) filled in place,
+               e.g. a np.memmap for very long stacks
+
+        Outputs:
+        ------------------
+        :out - float32 array of shape (points, time); nan for points outside the raster
+        :files - list of raster paths in column order
+        '''
+        self._validateType(self.raster, 'raster')
+        self._validateType(geopnts, 'vector')
+        files= sorted(glob.glob(rasters)) if isinstance(rasters, str) else list(rasters)
+        geopnts= self._alignCRS(geopnts)
+        lons= np.asarray(geopnts.layer.geometry.x, dtype=np.float64)
+        lats= np.asarray(geopnts.layer.geometry.y, dtype=np.float64)
+        cols, rows, inside= self._insidePixels(*self._pixelCoords(lons, lats))
+        if out is None:
+            out= np.full((len(lons), len(files)), np.nan, dtype=np.float32)
+        elif out.shape!=(len(lons), len(files)):
+            raise ValueError('expected out of shape %s, but got %s'%(str((len(lons), len(files))), str(out.shape)))
+        else:
+            out[~inside]= np.nan
+        if not inside.any():
+            return out, files
+
+        # index table: runs of consecutive rows and the points falling in each run
+        pnt_ids= np.flatnonzero(inside)
+        icol= np.floor(cols[inside]).astype(np.int64)
+        irow= np.floor(rows[inside]).astype(np.int64)
+        x0, x1= icol.min(), icol.max()+1
+        order= np.argsort(irow, kind='stable')
+        sorted_rows= irow[order]
+        unique_rows= np.unique(sorted_rows)
+        breaks= np.flatnonzero(np.diff(unique_rows)>1)+1
+        starts= unique_rows[np.r_[0, breaks]]
+        ends= unique_rows[np.r_[breaks-1, len(unique_rows)-1]]+1
+        runs= []
+        for start, end in zip(starts, ends):
+            lo, hi= np.searchsorted(sorted_rows, [start, end])
+            members= order[lo:hi]
+            runs.append((start, end-start, pnt_ids[members], irow[members]-start, icol[members]-x0))
+
+        geotrans, shape= self.raster.geotransform, self.raster.shape
+        for t, filename in enumerate(files):
+            src= Raster(filename, cache=False)
+            if src.geotransform!=geotrans or src.shape!=shape:
+                raise ValueError('%s does not share the geotransform/shape of %s'%(filename, self.raster.filename))
+            for row0, nrows, ids, local_rows, local_cols in runs:
+                block= src.read_window(x0, row0, x1-x0, nrows, band=band)
+                out[ids, t]= block[local_rows, local_cols]
+
+        return out, files
+
+    def _insidePixels(self, cols, rows):
+        '''mask of fractional pixel coordinates falling inside the raster'''
+        nrows, ncols= self.raster.shape
+        # points exactly on the right/bottom edge belong to the last pixel
+        cols= np.where(cols==ncols, ncols-1e-9, cols)
+        rows= np.where(rows==nrows, nrows-1e-9, rows)
+        inside= (cols>=0) & (cols<ncols) & (rows>=0) & (rows<nrows)
+
+        return cols, rows, inside
+
+    def _asBands(self, arr):
+        '''view a (rows, cols) array as (1, rows, cols)'''
+        return arr[np.newaxis] if arr.ndim==2 else arr
+
+    def reshape(self, shape, dst=None, method='bilinear', proj=None, noData=-9999):
+        '''
+        Resample the raster in process. Downsampling by integer factors with
+        'average'/'mean', 'sum', 'max' or 'min' is done by numpy block aggregation
+        when the result stays in memory, everything else goes through gdal.Warp.
+
         Inputs:
         ------------------
         :shape - tuple or list; (rows, cols)
-        :method - str; ['bilinear' 'nearest', 'cubic', 'cubicspline', 'lanczos', 'average', 'mode']
-        :dst - str; output file path
-        :proj - str; projection
+        :method - str; ['bilinear' 'nearest', 'cubic', 'cubicspline', 'lanczos', 'average', 'mean',
+                  'mode', 'sum', 'max', 'min']
+        :dst - str; output file path, None keeps the result in memory
+        :proj - str; target projection, None keeps the source projection
         :noData - int; 
 
         Outputs:
         ------------------
         :rasterReshaped - geoPackage.io.Raster object
         '''
+        self._validateType(self.raster, 'raster')
+        methods= {'bilinear': 'bilinear', 'nearest': 'near', 'cubic': 'cubic', 'cubicspline': 'cubicspline',
+                  'lanczos': 'lanczos', 'average': 'average', 'mean': 'average', 'mode': 'mode',
+                  'sum': 'sum', 'max': 'max', 'min': 'min'}
+        if method not in methods:
+            raise ValueError('method %s not in %s'%(method, list(methods.keys())))
+        rows, cols= self.raster.shape
         Xori, Xres, Xskew, Yori, Yskew, Yres= self.raster.geotransform
-        rows, cols= self.raster.array
-        Xfac, Yfac= cols/shape[1], rows/shape[0]
-        rasterXres= Xres*Xfac
-        rasterYres= Yres*Yfac
+        newRows, newCols= shape
+        if (dst is None and proj is None and methods[method] in ('average', 'sum', 'max', 'min')
+                and Xskew==0 and Yskew==0 and rows%newRows==0 and cols%newCols==0):
+            Yfac, Xfac= rows//newRows, cols//newCols
+            arr= self._blockAggregate(self.raster.array, Yfac, Xfac, methods[method])
+            arr[np.isnan(arr)]= noData
+
+            return Raster.fromArray(arr, (Xori, Xres*Xfac, 0, Yori, 0, Yres*Yfac), crs=self.raster.crs, nodata=noData)
+
+        options= dict(width=newCols, height=newRows, resampleAlg=methods[method],
+                      dstNodata=noData, outputType=gdal.GDT_Float32)
+        if proj is not None:
+            options['dstSRS']= proj
         if dst is None:
-            if not os.path.exists('temp'): os.mkdir('temp')
-            dst= 'temp/temp_file.tif'
-        cmd= 'gdal_translate -ot Float32 -of GTIFF -a_sts %s -a_nodata %s -tr %s %s -r %s COMPRESS=Deflate %s'\
-            %(proj, str(noData), rasterXres, rasterYres, method, dst)
-        os.system(cmd)
-        if os.path.exists('temp/temp_file.tif'):
-            os.system('rm -r temp')
-        rasterReshaped= ReadFile(dst).raster
+            ds= gdal.Warp('', self.raster.layer, format='MEM', **options)
 
-        return rasterReshaped
+            return Raster('', layer=ds)
+        ds= gdal.Warp(dst, self.raster.layer, format='GTiff', creationOptions=['COMPRESS=DEFLATE'], **options)
+        ds= None
 
+        return Raster(dst)
 
+    def _blockAggregate(self, arr, Yfac, Xfac, method):
+        '''
+        aggregate (..., rows, cols) into (..., rows/Yfac, cols/Xfac) blocks,
+        ignoring nan and the raster nodata
+        '''
+        arr= np.array(arr, dtype=np.float32)
+        nodata= self.raster.nodata
+        if nodata is not None:
+            arr[arr==nodata]= np.nan
+        rows, cols= arr.shape[-2:]
+        blocks= arr.reshape(arr.shape[:-2]+(rows//Yfac, Yfac, cols//Xfac, Xfac))
+        reducers= {'average': np.nanmean, 'sum': np.nansum, 'max': np.nanmax, 'min': np.nanmin}
+        with warnings.catch_warnings():
+            # all-nan blocks stay nan
+            warnings.simplefilter('ignore', RuntimeWarning)
+            result= reducers[method](blocks, axis=(-3, -1))
+        if method=='sum':
+            result[np.isnan(blocks).all(axis=(-3, -1))]= np.nan
 
-    def latSplit(self, arr, del_deg=10, metric='sum'):
+        return result
+
+    def latSplit(self, arr=None, del_deg=10, metric='sum', weighted=False):
         '''
+        Aggregate the raster over latitude bands. Latitudes come from the raster
+        geotransform, bands are aligned to multiples of del_deg starting at 90S,
+        and all bands are reduced in one pass.
+
         Inputs:
         -----------------
-        :arr - array (1800,3600)
-        :del_deg - int, degree band that want to aggregate with
+        :arr - array of shape (rows, cols) on the raster grid, by default the raster
+               itself with nodata masked
+        :del_deg - float, degree band that want to aggregate with
+        :metric - str; 'sum', 'mean' or 'median'
+        :weighted - bool; weight cells by their area (cosine of latitude), not
+                    available for 'median'
 
         Return:
         -----------------
-        :results - dict, key of band name, value of metric over band
+        :results - dict, key of band name (e.g. '10S-0N'), value of metric over band,
+                   ordered from south to north
         '''
-        results= {}
+        self._validateType(self.raster, 'raster')
+        if metric not in ('sum', 'mean', 'median'):
+            raise ValueError('metric %s not in %s'%(metric, ['sum', 'mean', 'median']))
+        if weighted and metric=='median':
+            raise ValueError('area weighting is not available for median')
+        if arr is None:
+            arr= np.array(self.raster.read_window(0, 0, self.raster.shape[1], self.raster.shape[0], band=1), dtype=np.float64)
+            if self.raster.nodata is not None:
+                arr[arr==self.raster.nodata]= np.nan
         self._validateType(arr, 'array')
-        for lat in range(0,180,10):
-            del_arr= lat*10
-            if lat<900: name= '%sS-%sS'%(lat, lat+del_deg)
-            elif lat>=900: name= '%sN-%sN'%(lat, lat+del_deg)
-            results[name]= self._bandAgg(arr[:, del_arr:del_arr*2], metric)
+        if arr.shape!=tuple(self.raster.shape):
+            raise ValueError('expected array of shape %s, but got %s'%(str(self.raster.shape), str(arr.shape)))
+        Xori, Xres, Xskew, Yori, Yskew, Yres= self.raster.geotransform
+        rows= arr.shape[0]
+        lats= Yori+ (np.arange(rows)+0.5)*Yres
+        band_ids= np.floor((lats+90.)/del_deg).astype(np.int64)
+        # rows of one band are contiguous: scatter them into (bands, rows per band, cols)
+        bands, first, counts= np.unique(band_ids, return_index=True, return_counts=True)
+        band_index= np.searchsorted(bands, band_ids)
+        position= np.arange(rows)- first[band_index]
+        stacked= np.full((len(bands), counts.max(), arr.shape[1]), np.nan, dtype=np.float64)
+        stacked[band_index, position]= arr
+        weights= None
+        if weighted:
+            weights= np.zeros(stacked.shape[:2])
+            weights[band_index, position]= np.cos(np.deg2rad(lats))
+        values= self._bandAgg(stacked, metric, weights)
+
+        results= {}
+        for band, value in zip(bands, values):
+            south= -90.+ band*del_deg
+            results['%s-%s'%(self._latName(south), self._latName(min(south+del_deg, 90.)))]= value
 
         return results
 
-    def _bandAgg(self, arr, metric):
+    def _latName(self, lat):
+        return '%gS'%(-lat) if lat<0 else '%gN'%lat
+
+    def _bandAgg(self, arr, metric, weights=None):
         '''
         Inputs:
         ---------------
-        :arr - aray of shape (1800,3600)
+        :arr - array of shape (bands, rows, cols), nan padded
+        :weights - array of shape (bands, rows); row weights
 
         Return:
         ---------------
-        :value - band aggregated results
+        :value - array of shape (bands,); band aggregated results
         '''
+        if weights is not None:
+            weights= np.where(np.isnan(arr), 0, weights[:, :, np.newaxis])
+            total= np.nansum(arr*weights, axis=(1,2))
+            if metric=='sum':
+                return total
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return total/weights.sum(axis=(1,2))
 
-        if metric=='sum':
-            value= np.nansum(arr,axis=1)
-        elif metric=='mean':
-            value= np.nanmean(arr, axis=1)
-        elif metric=='median':
-            value= np.nanmedian(arr, axis=1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if metric=='sum':
+                value= np.nansum(arr, axis=(1,2))
+            elif metric=='mean':
+                value= np.nanmean(arr, axis=(1,2))
+            elif metric=='median':
+                value= np.nanmedian(arr.reshape(arr.shape[0], -1), axis=1)
 
         return value
 
-
-    def _pointsampling(self, raster, x, y):
-        arr= raster.array
-        if x<arr.shape[1] and y<arr.shape[0]:
-            return arr[y,x]
-        else:
-            x= x-1
-            return arr[y, x]
-
     def _validateType(self, src, dtype):
         types= {'raster': Raster,
                 'vector': Vector,
-                'array' : np.array,
+                'array' : np.ndarray,
                 'list': list,
                 'set': set,
                 }
         if not isinstance(src, types[dtype]):
             raise ValueError('input type %s is not desired %s!'%(type(src), str(types[dtype])))
 
-    def _validateCRS(self, *args):
-        crs= None
-        first=True
-        for layer in args:
-            if first:
-                first= False
-                crs= layer.crs
-            else:
-                if crs!=layer.crs: raise ValueError('%s CRS is not equal to %s'%(layer.crs, crs))
+    def _alignCRS(self, vector):
+        '''vector in the raster crs, reprojected once and memoized by Vector.to_crs'''
+        return vector.to_crs(self.raster.crs)
+
+    def _cutline(self, vector):
+        '''
+        path GDAL can open as a cutline: the vector file itself, or for in-memory and
+        pruned vectors a copy written once to /vsimem
+        '''
+        if vector.filename and vector.bbox is None and vector.mask is None and vector.rows is None:
+            return vector.filename
+        if vector in _CUTLINES:
+            return _CUTLINES[vector]
+        filename= '/vsimem/geoPackage_cutline_%d.geojson'%id(vector)
+        gdal.Unlink(filename)
+        source= ogr.GetDriverByName('GeoJSON').CreateDataSource(filename)
+        srs= None
+        if vector.crs is not None:
+            srs= osr.SpatialReference()
+            srs.ImportFromWkt(vector.crs.to_wkt())
+        layer= source.CreateLayer('cutline', srs=srs, geom_type=ogr.wkbUnknown)
+        for geometry in vector.layer.geometry.values:
+            if geometry is None or geometry.is_empty:
+                continue
+            feature= ogr.Feature(layer.GetLayerDefn())
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(geometry.wkb))
+            layer.CreateFeature(feature)
+        source= None
+        _CUTLINES[vector]= filename
+        # free the in-memory file along with the vector
+        weakref.finalize(vector, gdal.Unlink, filename)
+
+        return filename
@@ -4,37 +4,60 @@ This function implements block-wise calculation for computing some statistics
 import h5py
 import numpy as np
 import os
-import datetime
-import scipy
+import scipy.stats
 import itertools
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
+from .catalog import Catalog, readMap
 
 class Block:
     '''
-    This block iteration calculates basic statistics for 20 yrs data
+    This block iteration calculates basic statistics for 20 yrs data. Every
+    early/final file pair is read exactly once and folded into running
+    accumulators over the whole grid (see Accumulator).
 
     Attributes:
     ------------------
-    :window_size - Tuple like; by default 10x10
-    :early_folders - str; where the early run are stored
-    :late_folders - str; where the late runs are stored
+    :catalog - Catalog (HDF5 files) or Store (repacked archive); source of early/final pairs
+    :start, end, months - date range and month subset to process
     :lon_lens - int; length of longitudes
     :lat_lens - int; length of latitudes
+    :accumulator - Accumulator; running sums of the current run
 
     Methods:
     ------------------
-    main_loop() - controls block
-    file_loop() - controls IO
-    retrieve() - extract information from HDF5 file
-    fileDateAssert() - assertion for dates
+    main_loop() - single pass over all files, fills self.stats
+    file_loop() - controls IO, yields early/final file pairs
+    prefetch() - reads upcoming file pairs in background threads
+    parallel_loop() - accumulates row stripes in worker processes over shared memory
+    retrieve() - read one early/final pair through the catalog, no data set to nan
     dataAssert() - assertion for data to have the expected dimension
-    dataClean() - preprocess for data, normally fill no data with nan
     '''
 
-    def __init__(self, window_size=(10,10)):
-
-        self.window_size= window_size
-        self.early_folders= [str(i) for i in range(2000, 2020)]
-        self.final_folders= [str(i)+'_final' for i in range(2000, 2020)]
+    def __init__(self, root=None, start=None, end=None, months=None, catalog=None, refresh=False, index=None):
+        '''
+        Inputs:
+        ------------------
+        :root - str; archive root with <year>/<day> early and <year>_final/<day> final folders,
+                required unless catalog is given
+        :start, end - datetime or 'YYYYmmdd' str; half open date range to process, None is open
+        :months - list of int; only process these calendar months
+        :catalog - geoPackage.catalog.Catalog or geoPackage.store.Store; source of the
+                   early/final pairs, by default Catalog(root)
+        :refresh - bool; rescan the whole archive instead of only its new or modified
+                   top-level folders, see Catalog
+        :index - str; json index path of the catalog, see Catalog
+        '''
+        if catalog is None:
+            if root is None:
+                raise ValueError('Block needs an archive root or a catalog')
+            catalog= Catalog(root, index=index, refresh=refresh)
+        self.catalog= catalog
+        self.start= start
+        self.end= end
+        self.months= months
         self.lon_lens= 3600
         self.lat_lens= 1800
         dt = np.dtype([('pearsonr', np.float16),
@@ -45,86 +68,266 @@ class Block:
                        ('MAE', np.float32),
                        ('normMAE', np.float32)])
         self.stats= np.zeros((self.lat_lens, self.lon_lens), dtype=dt)
+        self.accumulator= None
 
-    def main_loop(self, threads=10):
-        pool= multiprocessing.Pool(threads)
-        m,n= self.window_size
-        early_arr= np.zeros((m,n,1), dtype=np.float32)
-        late_arr= early_arr.copy()
-        num_m, num_n= self.lat_lens//m; self.lon_lens//n
-        stats= Stats()
-        for i in range(num_m):
-            for j in range(num_n):
-                for block_arr_early, block_arr_late in self.file_loop(i,j):
-                    early_arr= np.stack([early_arr, block_arr_early[:,:,np.newaxis]], axis=2)
-                    late_arr= np.stack([late_arr, block_arr_late[:,:,np.newaxis]], axis=2)
-                _,_,t= early_arr.shape
-                early_arr= early_arr.reshpae(m*n,t)
-                early_arr= [early_arr[i,:] for i in range(m*n)]
-                late_arr= late_arr.reshape(m*n,t)
-                late_arr= [ late_arr[i,:] for i in range(m*n)]
-                r, mae, normMAE, rmse, normRMSE= pool.starmap(stats.main, zip(early_arr, late_arr))
-                self.stats['pearsonr'][i*m:*(i+1)*m, j*n:*(j+1)*n]= np.array(r).reshape(m,n)
-                self.stats['normRMSE'][i*m:*(i+1)*m, j*n:*(j+1)*n]= np.array(normRMSE).reshape(m,n)
-                self.stats['mae'][i*m:*(i+1)*m, j*n:*(j+1)*n]= np.array(mae).reshape(m,n)
-                self.stats['normMAE'][i*m:*(i+1)*m, j*n:*(j+1)*n]= np.array(normMAE).reshape(m,n)
-                self.stats['rmse'][i*m:*(i+1)*m, j*n:*(j+1)*n]= np.array(rmse).reshape(m,n)
-
-
-    def file_loop(self, block_i, block_j):
-        m,n= self.window_size
-        for folder in self.early_folders:
-            days= sorted(os.listdir(os.path.join(folder)))
-            for day in days:
-                dst_early= os.path.join(folder, day)
-                dst_late= os.path.join(folder+'_final', day)
-                files_early= os.listdir(dst_early)
-                files_late= os.listdir(dst_late)
-                if len(files_early)!=48 and len(files_late)!=48:
-                    raise FileNotFoundError('expected 48 files inside one day folder!, but got %d, %d for early and late'%(len(files_early), len(files_late)))
-                else:
-                    for i, f in enumerate(sorted(files_early)):
-                        early_h5= f
-                        late_h5= files_late[i]
-                        self.fileDateAssert(early_h5, late_h5)
-                        early_map, late_map= self.retrieve(h5_early, late_h5)
-
-                        yield early_map[block_i*m:*(block_i+1)*m, block_j*n:*(block_j+1)*n], late_map[block_i*m:*(block_i+1)*m, block_j*n:*(block_j+1)*n]
-
-
-    def retrieve(self, h5_early, h5_late):
+    def main_loop(self, checkpoint=None, every=480, workers=2, depth=4, processes=None):
+        '''
+        Inputs:
+        ------------------
+        :checkpoint - str; HDF5 file holding the accumulators and the list of processed
+                      files. If it exists the run resumes from it and skips files already
+                      processed, which also allows extending `end` by e.g. a new year
+        :every - int; save the checkpoint every this many new file pairs (480 = 10 days)
+        :workers - int; reader threads decoding upcoming file pairs while the current
+                   one is accumulated, 0 reads serially
+        :depth - int; number of file pairs decoded ahead (and of preallocated buffers)
+        :processes - int; run parallel_loop over this many row stripes instead; the
+                     checkpoint is then only written once all stripes finished
+        '''
+        done= set()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.accumulator, done= Accumulator.load(checkpoint, (self.lat_lens, self.lon_lens))
+        else:
+            self.accumulator= Accumulator((self.lat_lens, self.lon_lens))
+        pairs= [pair for pair in self.file_loop() if self.catalog.key(pair[0]) not in done]
+        if processes:
+            self.parallel_loop(pairs, processes)
+            done.update(self.catalog.key(h5_early) for h5_early, _ in pairs)
+            reader, new= [], len(pairs)
+        elif workers:
+            reader, new= self.prefetch(pairs, workers, depth), 0
+        else:
+            reader, new= ((pair, self.retrieve(*pair)) for pair in pairs), 0
+        for (h5_early, h5_late), (early_map, late_map) in reader:
+            self.accumulator.update(early_map, late_map)
+            done.add(self.catalog.key(h5_early))
+            new+= 1
+            if checkpoint is not None and new%every==0:
+                self.accumulator.save(checkpoint, done)
+        if checkpoint is not None and new>0:
+            self.accumulator.save(checkpoint, done)
+        self.accumulator.finalize(self.stats)
+
+        return self.stats
+
+    def file_loop(self):
+        # pairs are matched on their timestamps by the catalog
+        for h5_early, h5_late in self.catalog.pairs(self.start, self.end, self.months, strict=True):
+            yield h5_early, h5_late
+
+    def parallel_loop(self, pairs, processes=4):
+        '''
+        Accumulate file pairs in parallel over row stripes of the grid. The
+        accumulators live in multiprocessing.shared_memory, every worker owns one
+        stripe of them and reads only its row hyperslab from each HDF5 file, so no
+        arrays are pickled between processes.
+
+        Inputs:
+        ------------------
+        :pairs - list of (h5_early, h5_late) file paths
+        :processes - int; number of worker processes (row stripes)
+        '''
+        shape= (self.lat_lens, self.lon_lens)
+        stripes= [(rows[0], rows[-1]+1) for rows in np.array_split(np.arange(shape[0]), processes) if len(rows)]
+        blocks= {}
+        try:
+            for field in Accumulator.fields:
+                source= getattr(self.accumulator, field)
+                blocks[field]= shared_memory.SharedMemory(create=True, size=source.nbytes)
+                np.ndarray(shape, dtype=source.dtype, buffer=blocks[field].buf)[...]= source
+            names= {field: (block.name, getattr(self.accumulator, field).dtype.str) for field, block in blocks.items()}
+            workers= [multiprocessing.Process(target=_stripeWorker, args=(names, shape, stripe, pairs, self.catalog))
+                      for stripe in stripes]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            failed= [worker.exitcode for worker in workers if worker.exitcode!=0]
+            if failed:
+                raise RuntimeError('%d of %d stripe workers failed with exit codes %s'%(len(failed), len(workers), failed))
+            for field, block in blocks.items():
+                target= getattr(self.accumulator, field)
+                target[...]= np.ndarray(shape, dtype=target.dtype, buffer=block.buf)
+        finally:
+            for block in blocks.values():
+                block.close()
+                block.unlink()
+
+    def prefetch(self, pairs, workers=2, depth=4):
+        '''
+        Decode file pairs ahead of the consumer in a thread pool. At most `depth`
+        pairs are in flight, each read into its own preallocated buffers, and a
+        buffer is reused once the consumer asks for the next pair.
+        h5py serializes HDF5 calls inside one process, so the gain is overlapping
+        reading with accumulation rather than parallel decoding.
+
+        Outputs:
+        ------------------
+        :generator of ((h5_early, h5_late), (early_map, late_map))
+        '''
+        shape= (self.lat_lens, self.lon_lens)
+        free= [(self.catalog.buffer(shape), self.catalog.buffer(shape)) for _ in range(depth)]
+        pairs= iter(pairs)
+        pending= collections.deque()
+        with ThreadPoolExecutor(workers) as executor:
+            def submit():
+                pair= next(pairs, None)
+                if pair is not None:
+                    buffers= free.pop()
+                    pending.append((pair, buffers, executor.submit(self.retrieve, pair[0], pair[1], *buffers)))
+            for _ in range(depth):
+                submit()
+            while pending:
+                pair, buffers, future= pending.popleft()
+                yield pair, future.result()
+                free.append(buffers)
+                submit()
+
+    def retrieve(self, h5_early, h5_late, early=None, late=None):
         """
         :file - .HDF5 file
+        :early, late - optional float32 buffers of shape (lon_lens, lat_lens) to read into
+
+        returns (lat, lon) views of the buffers, negative values set to nan
         """
-        early_map= np.array(h5py.File(h5_early, 'r')['Grid/precipitationCal']).transpose().squeeze()
-        late_map= np.array(h5py.File(h5_late, 'r')['Grid/precipitationCal']).transpose().squeeze()
+        early_map= self.catalog.read(h5_early, early)
+        late_map= self.catalog.read(h5_late, late)
         self.dataAssert(early_map, late_map)
-        self.dataClean(early_map, late_map)
 
         return early_map, late_map
 
-    def fileDateAssert(self, file1, file2):
+    def dataAssert(self, *args):
+        for arg in args:
+            assert arg.shape==(self.lat_lens, self.lon_lens), 'expected map size %s, but got %s'%(str((self.lat_lens, self.lon_lens)), str(arg.shape))
+
+def _stripeWorker(names, shape, stripe, pairs, source):
+    '''worker of Block.parallel_loop: accumulate the rows stripe[0]:stripe[1] of every pair'''
+    blocks= {field: shared_memory.SharedMemory(name=name) for field, (name, _) in names.items()}
+    try:
+        buffers= {field: np.ndarray(shape, dtype=np.dtype(names[field][1]), buffer=block.buf)[stripe[0]:stripe[1]]
+                  for field, block in blocks.items()}
+        accumulator= Accumulator((stripe[1]-stripe[0], shape[1]), buffers=buffers)
+        early= source.buffer(shape, stripe)
+        late= source.buffer(shape, stripe)
+        for h5_early, h5_late in pairs:
+            accumulator.update(source.read(h5_early, early, stripe), source.read(h5_late, late, stripe))
+        del accumulator, buffers
+    finally:
+        for block in blocks.values():
+            block.close()
+
+class Accumulator:
+    '''
+    Running sums for the early (x) / final (y) comparison of every pixel, so that
+    the statistics of a long record are computed from a single pass over the data.
+
+    Attributes:
+    ------------------
+    :count - int; number of time steps where both x and y are valid
+    :sum_x, sum_y, sum_xx, sum_yy, sum_xy - float64; raw moments
+    :sum_abs - float64; sum of |x-y|
+    :sum_sq - float64; sum of (x-y)**2
+    '''
+    fields= ('count', 'sum_x', 'sum_y', 'sum_xx', 'sum_yy', 'sum_xy', 'sum_abs', 'sum_sq')
+
+    def __init__(self, shape, buffers=None):
         '''
-        According to fine name convention, e.g. 20000601-S000000-E002900.HDF5
+        :shape - tuple; (rows, cols)
+        :buffers - dict; existing arrays (e.g. views of shared memory) to accumulate into
         '''
-        date1, time1= file1.split('-')[:2]
-        time1= time1[1:]
-        date2, time2= file2.split('-')[:2]
-        time2= time2[1:]
-        datetime1= datetime.datetime.strptime(date1+time1, format="%Y%m%d%H%M%S")
-        datetime2= datetime.datetime.strptime(date2+time2, format="%Y%m%d%H%M%S")
-        if datetime1!= datetime2:
-            raise ValueError('two map dates are inconsistent, one is %s, the other is %s'%(str(datetime1), str(datetime2)))
+        self.shape= tuple(shape)
+        for field in self.fields:
+            if buffers is not None:
+                setattr(self, field, buffers[field])
+            else:
+                setattr(self, field, np.zeros(self.shape, dtype=np.int64 if field=='count' else np.float64))
 
-    def dataAssert(self, *args):
-        for arg in args:
-            assert arg.shape==(1800,3600), 'expected map size (1800,3600), but got %s'%(str(arg.shape))
+    def update(self, x, y):
+        '''
+        :x, y - arrays of self.shape for one time step, nan where missing
+        '''
+        valid= ~(np.isnan(x) | np.isnan(y))
+        x= np.where(valid, x, 0).astype(np.float64)
+        y= np.where(valid, y, 0).astype(np.float64)
+        diff= x- y
+        self.count+= valid
+        self.sum_x+= x
+        self.sum_y+= y
+        self.sum_xx+= x*x
+        self.sum_yy+= y*y
+        self.sum_xy+= x*y
+        self.sum_abs+= np.abs(diff)
+        self.sum_sq+= diff*diff
 
-    def dataClean(self, *args):
-        for arg in args:
-            arg[arg<0]= np.nan
+    def save(self, filename, manifest=()):
+        '''
+        Write the accumulators and the manifest of processed files to HDF5. The file
+        is written next to the target and renamed, so a crash never leaves a
+        half-written checkpoint behind.
+        '''
+        tmp= filename+'.tmp'
+        with h5py.File(tmp, 'w') as f:
+            for field in self.fields:
+                f.create_dataset(field, data=getattr(self, field))
+            f.create_dataset('manifest', data=sorted(manifest), dtype=h5py.string_dtype())
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename, shape=None):
+        '''
+        Inputs:
+        ------------------
+        :filename - str; checkpoint written by save()
+        :shape - tuple; expected (rows, cols) of the grid, a checkpoint of another grid
+                 raises ValueError
+
+        Outputs:
+        ------------------
+        :accumulator - Accumulator restored from a checkpoint written by save()
+        :manifest - set of processed file names
+        '''
+        with h5py.File(filename, 'r') as f:
+            if shape is not None and f['count'].shape!=tuple(shape):
+                raise ValueError('checkpoint %s holds a grid of shape %s, but expected %s'%(filename, str(f['count'].shape), str(tuple(shape))))
+            accumulator= cls(f['count'].shape)
+            for field in cls.fields:
+                f[field].read_direct(getattr(accumulator, field))
+            manifest= set(name.decode() if isinstance(name, bytes) else name for name in f['manifest'][:])
 
-        return args
+        return accumulator, manifest
+
+    def finalize(self, stats=None):
+        '''
+        Inputs:
+        ------------------
+        :stats - structured array with fields of Block.stats to fill in place
+
+        Outputs:
+        ------------------
+        :metrics - dict of arrays; pearsonr, std (std of x normalized by std of y),
+                   volume_loss, normRMSE, RMSE, MAE, normMAE; nan where undefined
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            n= np.where(self.count>0, self.count, np.nan)
+            mean_x= self.sum_x/n
+            mean_y= self.sum_y/n
+            var_x= np.maximum(self.sum_xx/n- mean_x**2, 0)
+            var_y= np.maximum(self.sum_yy/n- mean_y**2, 0)
+            cov= self.sum_xy/n- mean_x*mean_y
+            mean_y= np.where(mean_y==0, np.nan, mean_y)
+            rmse= np.sqrt(self.sum_sq/n)
+            metrics= {'pearsonr': np.where(self.count<2, np.nan, cov/np.sqrt(var_x*var_y)),
+                      'std': np.sqrt(var_x/var_y),
+                      'volume_loss': np.where(self.count>0, self.sum_y- self.sum_x, np.nan),
+                      'normRMSE': rmse/mean_y,
+                      'RMSE': rmse,
+                      'MAE': self.sum_abs/n,
+                      'normMAE': self.sum_abs/mean_y}
+        if stats is not None:
+            for key, value in metrics.items():
+                stats[key]= value
+
+        return metrics
 
 class Stats:
     """
@@ -142,11 +345,11 @@ class Stats:
         arr1= args[0]
         arr2= args[1]
         if metrics=='all':
-            r= self.pearsonr(self.arr1, self.arr2)
-            mae= self.mae(self.arr1, self.arr2)
-            normMAE= self.normMAE(self.arr1, self.arr2)
-            rmse= self.rmse(self,arr1, self.arr2)
-            normRMSE= self.normRMSE(self.arr1, self.arr2)
+            r= self.pearsonr(arr1, arr2)
+            mae= self.mae(arr1, arr2)
+            normMAE= self.normMAE(arr1, arr2)
+            rmse= self.rmse(arr1, arr2)
+            normRMSE= self.normRMSE(arr1, arr2)
 
             return r, mae, normMAE, rmse, normRMSE
 
@@ -204,3 +407,82 @@ class Stats:
         intersection= ~ind_x * ~ ind_y
 
         return x[intersection], y[intersection]
+
+class StackStats(Stats):
+    """
+    Array-level variants of Stats: x, y are stacks of shape (time, rows, cols)
+    (any shape with time on the first axis) and every metric is computed for all
+    pixels at once along the time axis. Time steps where either x or y is nan
+    are ignored, pixels without enough valid steps get nan.
+    """
+
+    def main(self, *args, metrics='all'):
+        x, y= self.protection_nan(args[0], args[1])
+        if metrics=='all':
+            r= self.pearsonr(x, y)
+            mae= self.mae(x, y)
+            normMAE= self.normMAE(x, y)
+            rmse= self.rmse(x, y)
+            normRMSE= self.normRMSE(x, y)
+
+            return r, mae, normMAE, rmse, normRMSE
+
+    def pearsonr(self, x, y):
+        x, y= self.protection_nan(x, y)
+        n= self.count(x)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dx= x- self._mean(x)
+            dy= y- self._mean(y)
+            r= np.nansum(dx*dy, axis=0)/np.sqrt(np.nansum(dx*dx, axis=0)*np.nansum(dy*dy, axis=0))
+
+        return np.where(n<2, np.nan, r)
+
+    def mae(self, x, y):
+        x, y= self.protection_nan(x, y)
+
+        return self._mean(np.abs(x-y))
+
+    def normMAE(self, x, y):
+        x, y= self.protection_nan(x, y)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            value= np.nansum(np.abs(x-y), axis=0)/self._nonzero(self._mean(y))
+
+        return np.where(self.count(x)==0, np.nan, value)
+
+    def rmse(self, x, y):
+        x, y= self.protection_nan(x, y)
+
+        return self._mean((x-y)**2)**0.5
+
+    def normRMSE(self, x, y):
+        x, y= self.protection_nan(x, y)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._mean(((x-y)/self._nonzero(self._mean(y)))**2)**0.5
+
+    def volume_loss(self, x, y):
+        # total volume deficit, final run - early run
+        x, y= self.protection_nan(x, y)
+        value= np.nansum(y, axis=0)- np.nansum(x, axis=0)
+
+        return np.where(self.count(x)==0, np.nan, value)
+
+    def protection_nan(self, x, y):
+        #mask time steps where either stack is nan
+        x= np.asarray(x, dtype=np.float64)
+        y= np.asarray(y, dtype=np.float64)
+        missing= np.isnan(x) | np.isnan(y)
+        if not missing.any():
+            return x, y
+
+        return np.where(missing, np.nan, x), np.where(missing, np.nan, y)
+
+    def count(self, x):
+        return (~np.isnan(x)).sum(axis=0)
+
+    def _mean(self, x):
+        n= self.count(x)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(n==0, np.nan, np.nansum(x, axis=0)/n)
+
+    def _nonzero(self, x):
+        return np.where(x==0, np.nan, x)
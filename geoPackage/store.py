@@ -0,0 +1,238 @@
+"""
+Consolidated store: an IMERG archive repacked into one chunked, compressed HDF5 file
+"""
+import os
+import threading
+import warnings
+import h5py
+import numpy as np
+from .io import H5, _bboxWindow, _cubeOut
+from .catalog import readMap, selectKey, timestampKey, _dateKey
+
+# chunk shapes (time, lat, lon) per layout; 'time' favours per-pixel time series and
+# small-bbox cubes, 'space' favours reading whole maps (Block)
+LAYOUTS= {'time': (48, 32, 32),
+          'space': (1, 360, 720)}
+
+
+def repack(catalog, dst, start=None, end=None, months=None, layout='time', compression='gzip',
+           var='Grid/precipitationCal'):
+    '''
+    Repack the early/final pairs of a catalog into one HDF5 store with datasets
+    'early' and 'final' of shape (time, lat, lon), plus 'keys' (timestamps), 'names'
+    (early file names, the manifest keys of Block checkpoints), 'lats' and 'lons'.
+
+    Maps are written in slabs of one time chunk, so each chunk is compressed once;
+    the 'time' layout holds 48 maps in memory while writing. Use layout='space' for
+    stores processed by Block, which reads one whole map per step.
+
+    Inputs:
+    ------------------
+    :catalog - geoPackage.catalog.Catalog
+    :dst - str; output .h5 path
+    :start, end, months - selection passed to catalog.pairs()
+    :layout - str; 'time' or 'space', see LAYOUTS
+    :compression - str; h5py compression filter, None stores raw
+
+    Outputs:
+    ------------------
+    :store - Store opened on dst
+    '''
+    if layout not in LAYOUTS:
+        raise ValueError('layout %s not in %s'%(layout, list(LAYOUTS.keys())))
+    pairs= catalog.pairs(start, end, months, strict=True)
+    if not pairs:
+        raise FileNotFoundError('no early/final pairs selected in %s'%catalog.root)
+    with H5(pairs[0][0]) as first:
+        lats, lons= first.lats, first.lons
+    shape= (len(pairs), len(lats), len(lons))
+    chunks= tuple(min(c, n) for c, n in zip(LAYOUTS[layout], shape))
+    names= [catalog.key(h5_early) for h5_early, _ in pairs]
+    keys= [timestampKey(h5_early) for h5_early, _ in pairs]
+
+    tmp= dst+'.tmp'
+    with h5py.File(tmp, 'w') as f:
+        f.attrs['layout']= layout
+        f.create_dataset('lats', data=lats)
+        f.create_dataset('lons', data=lons)
+        f.create_dataset('keys', data=keys, dtype=h5py.string_dtype())
+        f.create_dataset('names', data=names, dtype=h5py.string_dtype())
+        slab= np.empty((chunks[0],)+shape[1:], dtype=np.float32)
+        buffer= np.empty((shape[2], shape[1]), dtype=np.float32)
+        for run, index in (('early', 0), ('final', 1)):
+            dataset= f.create_dataset(run, shape=shape, chunks=chunks, dtype=np.float32, fillvalue=np.nan,
+                                      compression=compression, shuffle=compression is not None)
+            for t0 in range(0, shape[0], chunks[0]):
+                t1= min(t0+chunks[0], shape[0])
+                for t in range(t0, t1):
+                    slab[t-t0]= readMap(pairs[t][index], buffer, var=var)
+                dataset[t0:t1]= slab[:t1-t0]
+    os.replace(tmp, dst)
+
+    return Store(dst)
+
+
+class Store:
+    '''
+    Reader of a store written by repack(). It offers the same pairs()/key()/buffer()/
+    read() interface as geoPackage.catalog.Catalog, so Block runs on it unchanged,
+    and a cube() method used by geoPackage.io.readCube.
+
+    Inputs:
+    ------------------
+    :filename - str; store path
+    :rdcc_nbytes - int; HDF5 chunk cache size in bytes, default 64 MB
+    :slab_nbytes - int; on stores chunked along time, read() decodes all time steps
+                   of a chunk at once if they fit in this many bytes, default 512 MB
+    '''
+
+    def __init__(self, filename, rdcc_nbytes=64*1024**2, slab_nbytes=512*1024**2):
+        self.filename= filename
+        self.rdcc_nbytes= rdcc_nbytes
+        self.slab_nbytes= slab_nbytes
+        self._handle= None
+        self._pid= None
+        self._slabs= {}
+        self._lock= threading.Lock()
+        self._warned= False
+        f= self.layer
+        self.layout= f.attrs.get('layout', '')
+        self.keys= [k.decode() if isinstance(k, bytes) else k for k in f['keys'][:]]
+        self.names= [n.decode() if isinstance(n, bytes) else n for n in f['names'][:]]
+        self.lats= f['lats'][:]
+        self.lons= f['lons'][:]
+
+    @property
+    def layer(self):
+        # h5py handles are not fork-safe: every process opens its own
+        if self._handle is None or self._pid!=os.getpid():
+            self._handle= h5py.File(self.filename, 'r', rdcc_nbytes=self.rdcc_nbytes)
+            self._pid= os.getpid()
+        return self._handle
+
+    @property
+    def shape(self):
+        return self.layer['early'].shape
+
+    def __getstate__(self):
+        state= self.__dict__.copy()
+        state['_handle']= None
+        state['_slabs']= {}
+        del state['_lock']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock= threading.Lock()
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle= None
+
+    def pairs(self, start=None, end=None, months=None, strict=False):
+        '''
+        Outputs:
+        ------------------
+        :pairs - list of (('early', t), ('final', t)) references sorted by time;
+                 a store only holds complete pairs, strict is accepted for compatibility
+        '''
+        start, end= _dateKey(start), _dateKey(end)
+
+        return [(('early', t), ('final', t)) for t, key in enumerate(self.keys) if selectKey(key, start, end, months)]
+
+    def key(self, ref):
+        return self.names[ref[1]]
+
+    def buffer(self, shape, rows=None):
+        nrows= shape[0] if rows is None else rows[1]-rows[0]
+
+        return np.empty((nrows, shape[1]), dtype=np.float32)
+
+    def read(self, ref, buffer=None, rows=None):
+        '''
+        Inputs:
+        ------------------
+        :ref - tuple; ('early' or 'final', time index) from pairs()
+        :buffer - float32 array of shape (rows, lon) to read into
+        :rows - tuple; (first, last+1) latitude rows, None reads the whole map
+
+        Outputs:
+        ------------------
+        :map - (rows, lon) array, negative values set to nan
+
+        Maps of a store chunked along time are served from a slab of one time chunk,
+        decoded once per chunk instead of once per map; slabs larger than slab_nbytes
+        (e.g. whole global maps of the 'time' layout) are not cached.
+        '''
+        run, t= ref
+        dataset= self.layer[run]
+        lat_sel= slice(None) if rows is None else slice(rows[0], rows[1])
+        if buffer is None:
+            buffer= self.buffer(dataset.shape[1:], rows)
+        step= dataset.chunks[0] if dataset.chunks else 1
+        if step>1 and step*buffer.nbytes<=self.slab_nbytes:
+            t0= t-t%step
+            with self._lock:
+                slab= self._slabs.get((run, rows))
+                if slab is None or slab[0]!=t0:
+                    data= np.empty((min(t0+step, dataset.shape[0])-t0,)+buffer.shape, dtype=np.float32)
+                    dataset.read_direct(data, source_sel=np.s_[t0:t0+len(data), lat_sel, :])
+                    slab= t0, data
+                    self._slabs[(run, rows)]= slab
+            buffer[...]= slab[1][t-t0]
+        else:
+            if step>1 and not self._warned:
+                self._warned= True
+                warnings.warn('%s is chunked along time (layout %s), every map read decodes %d time steps; '
+                              'repack with layout=\'space\' or raise slab_nbytes'%(self.filename, self.layout, step))
+            dataset.read_direct(buffer, source_sel=np.s_[t, lat_sel, :])
+        buffer[buffer<0]= np.nan
+
+        return buffer
+
+    def series(self, lat, lon, run='early'):
+        '''time series of the cell nearest to (lat, lon)'''
+        i= int(np.abs(self.lats-lat).argmin())
+        j= int(np.abs(self.lons-lon).argmin())
+
+        return self.layer[run][:, i, j]
+
+    def cube(self, bbox, start=None, end=None, months=None, run='early', out=None):
+        '''
+        Inputs:
+        ------------------
+        :bbox - tuple; (xmin, xmax, ymin, ymax) in degrees
+        :start, end, months - time selection, see pairs()
+        :run - str; 'early' or 'final'
+        :out - str or array; .npy path to memory-map the cube to disk, or a preallocated
+               array of shape (time, lat, lon); None allocates in memory
+
+        Outputs:
+        ------------------
+        :cube - float32 array of shape (time, lat, lon), negative values set to nan
+                like the maps of the original files (see readCube)
+        :lats, lons - 1-D coordinate arrays of the cube
+        '''
+        lat0, lat1, lon0, lon1= _bboxWindow(self.lats, self.lons, bbox)
+        times= np.array([ref[1] for ref, _ in self.pairs(start, end, months)], dtype=np.int64)
+        if len(times)==0:
+            raise ValueError('no time steps selected between %s and %s'%(start, end))
+        cube= _cubeOut(out, (len(times), lat1-lat0, lon1-lon0))
+        dataset= self.layer[run]
+        direct= cube.dtype==np.float32 and cube.flags.c_contiguous
+        # one hyperslab per run of consecutive time steps, e.g. per selected month
+        offset= 0
+        for steps in np.split(times, np.flatnonzero(np.diff(times)>1)+1):
+            selection= np.s_[int(steps[0]):int(steps[-1])+1, lat0:lat1, lon0:lon1]
+            if direct:
+                dataset.read_direct(cube, source_sel=selection, dest_sel=np.s_[offset:offset+len(steps)])
+            else:
+                cube[offset:offset+len(steps)]= dataset[selection]
+            offset+= len(steps)
+        cube[cube<0]= np.nan
+        if isinstance(cube, np.memmap):
+            cube.flush()
+
+        return cube, self.lats[lat0:lat1], self.lons[lon0:lon1]
@@ -40,7 +40,7 @@ def layout(src, *arg, **kargs):
         raise ValueError('expected geo.Package.io.Raster object, but get %s'%type(src))
 
     ulx, xres, _, uly, _, yres  = src.geotransform
-    m,n= src.array.shape
+    m,n= src.shape
     xmin= ulx+ 0.5*xres
     ymin= uly+ 0.5*yres
     xmax = xmin + ((src.layer.RasterXSize-0.5) * xres)
@@ -48,7 +48,8 @@ def layout(src, *arg, **kargs):
     lons= np.linspace(xmin, xmax, n)
     lats= np.linspace(ymin, ymax, m)
     x,y = np.meshgrid(lons, lats)
-    data= src.array
+    # copy, the raster keeps its decoded array cached
+    data= src.array.copy()
     if remove:
         data[data<0]= np.nan
     # print(xmin, xmax, ymin, ymax)
@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 import sys
 sys.path.append('..')
+import os
+import shutil
+import tempfile
 import unittest
 import matplotlib.pyplot as plt
 import geoPackage as gp
@@ -9,16 +12,25 @@ import geoPackage.io as io
 import geoPackage.raster as georaster
 import h5py
 import geopandas as gpd
+import shapely
 from osgeo import gdal
 from geoPackage.raster import Geoprocess
 from geoPackage.dataprocess import normalize
+from geoPackage.statistics import Accumulator, Block, StackStats
+from geoPackage.catalog import Catalog
+from geoPackage.store import repack
 import numpy as np
+from scipy import ndimage
 from geoPackage.visualize import layout
 
 
 RASTER_PTH= '/Users/allen/Documents/Python/global_analysis/geotiffs/e1.tif'
 VECTOR_PTH= '/Users/allen/Documents/Python/global_analysis/gisSrc/gauge_pnt_vector.shp'
 
+def _mean3(block):
+    # module level so that map_blocks can pickle it for worker processes
+    return ndimage.uniform_filter(block, 3, mode='nearest')
+
 class UnitTests(unittest.TestCase):
 
     def test_import(self):
@@ -54,6 +66,362 @@ class UnitTests(unittest.TestCase):
         # values= Geoprocess(raster).pointExtract(vector) # Pass point sampling 
         # print(values)
     
+    def test_raster_cache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            ras_pth= os.path.join(folder, 'e1.tif')
+            io.WriteFile(np.random.rand(90, 120).astype(np.float32), (-180, 3, 0, 90, 0, -2)).write(ras_pth)
+            raster= io.ReadFile(ras_pth, pool=False).raster
+            arr= raster.array
+            self.assertIs(raster.array, arr)                                        #decoded once
+            window= raster.read_window(10, 20, 30, 40)
+            self.assertTrue(np.array_equal(window, arr[20:60, 10:40]))
+            raster.invalidate()
+            self.assertIsNot(raster.array, arr)
+            self.assertTrue(np.array_equal(raster.array, arr))
+
+    def test_write_options(self):
+        arr= np.random.rand(600, 700).astype(np.float32)
+        with tempfile.TemporaryDirectory() as folder:
+            def written(name, **options):
+                ras_pth= os.path.join(folder, name)
+                io.WriteFile(arr, (-180, 0.5, 0, 90, 0, -0.25)).write(ras_pth, **options)
+                ds= gdal.Open(ras_pth)
+                self.assertTrue(np.array_equal(ds.ReadAsArray(), arr))
+                return ds
+            ds= written('tiled.tif', blocksize=128, compress='ZSTD', overviews=[2, 4])
+            self.assertEqual(ds.GetMetadata('IMAGE_STRUCTURE')['COMPRESSION'], 'ZSTD')
+            self.assertEqual(ds.GetMetadata('IMAGE_STRUCTURE')['PREDICTOR'], '3')            #floating point
+            self.assertEqual(ds.GetRasterBand(1).GetBlockSize(), [128, 128])
+            self.assertEqual(ds.GetRasterBand(1).GetOverviewCount(), 2)
+            ds= written('strips.tif', tiled=False, compress=None)
+            self.assertNotIn('COMPRESSION', ds.GetMetadata('IMAGE_STRUCTURE'))
+            self.assertEqual(ds.GetRasterBand(1).GetBlockSize()[0], 700)
+            ds= written('cog.tif', cog=True, blocksize=256)
+            self.assertEqual(ds.GetMetadata('IMAGE_STRUCTURE')['LAYOUT'], 'COG')
+            self.assertEqual(ds.GetMetadata('IMAGE_STRUCTURE')['COMPRESSION'], 'DEFLATE')
+            self.assertEqual(ds.GetRasterBand(1).GetBlockSize(), [256, 256])
+            self.assertGreater(ds.GetRasterBand(1).GetOverviewCount(), 0)                 #built by the driver
+            ds= written('cog_raw.tif', cog=True, compress=None)
+            self.assertNotIn('COMPRESSION', ds.GetMetadata('IMAGE_STRUCTURE'))
+            ds= None
+            self.assertRaises(ValueError, io.WriteFile(arr, (-180, 0.5, 0, 90, 0, -0.25)).write,
+                              os.path.join(folder, 'bad.tif'), cog=True, overviews=[2])
+
+    def test_raster_memmap(self):
+        arr= np.random.rand(2, 30, 40).astype(np.float32)
+        raster= io.Raster.fromArray(arr, (-180, 9, 0, 90, 0, -6), crs='EPSG:4326')
+        with tempfile.TemporaryDirectory() as folder:
+            envi= io.toENVI(raster, os.path.join(folder, 'grid.img'))
+            self.assertIsInstance(envi.array, np.memmap)                             #not decoded
+            self.assertTrue(np.array_equal(envi.array, arr))
+            self.assertEqual(envi.geotransform, raster.geotransform)
+            window= envi.read_window(5, 10, 20, 15, band=2)
+            self.assertTrue(np.shares_memory(window, envi.array))                     #zero-copy
+            envi.invalidate()
+
+    def test_block_writer(self):
+        arr= np.random.rand(2, 64, 80).astype(np.float32)
+        with tempfile.TemporaryDirectory() as folder:
+            dst= os.path.join(folder, 'blocks.tif')
+            buffer= np.empty((2, 16, 16), dtype=np.float32)
+            with io.BlockWriter(dst, (64, 80), (0, 1, 0, 64, 0, -1), bands=2, threaded=True, queue_size=2,
+                                blocksize=16) as writer:
+                for yoff in range(0, 64, 16):
+                    for xoff in range(0, 80, 16):
+                        buffer[:]= arr[:, yoff:yoff+16, xoff:xoff+16]                #reused by the caller
+                        writer.write_block(buffer, xoff, yoff)
+            self.assertTrue(np.array_equal(io.Raster(dst).array, arr))
+            with io.BlockWriter(os.path.join(folder, 'error.tif'), (64, 80), (0, 1, 0, 64, 0, -1), threaded=True) as writer:
+                self.assertRaises(ValueError, writer.write_block, arr[0, :16, :16], 0, 0, band=3)   #no band 3
+                self.assertRaises(ValueError, writer.write_block, arr[:, :16, :16], 0, 0)          #2 bands into 1
+                self.assertRaises(ValueError, writer.write_block, arr[0, :16, :16], 70, 0)         #out of bounds
+
+    def test_map_blocks(self):
+        arr= np.random.rand(37, 53).astype(np.float32)
+        expected= ndimage.uniform_filter(arr, 3, mode='nearest')                   #edge padded like the halo
+        with tempfile.TemporaryDirectory() as folder:
+            src= os.path.join(folder, 'src.tif')
+            io.WriteFile(arr, (0, 1, 0, 37, 0, -1)).write(src)
+            raster= io.Raster(src)
+            windows= [window for window, block in raster.iter_blocks(halo=1, blocksize=(16, 16))]
+            self.assertEqual(len(windows), 12)
+            for window, block in raster.iter_blocks(halo=1, blocksize=(16, 16)):
+                self.assertEqual(block.shape, (window.ysize+2, window.xsize+2))
+            result= raster.map_blocks(_mean3, halo=1, blocksize=(16, 16))
+            self.assertTrue(np.allclose(result.array, expected, atol=1e-6))
+            out= os.path.join(folder, 'mean.tif')
+            result= raster.map_blocks(_mean3, out=out, halo=1, blocksize=(16, 16), processes=2)
+            self.assertTrue(np.allclose(result.array, expected, atol=1e-6))
+
+    def test_reshape(self):
+        arr= np.arange(4*6, dtype=np.float32).reshape(4,6)
+        arr[0:2, 0:2]= -1                                                          #all-nodata block
+        arr[2, 4]= np.nan
+        raster= io.Raster.fromArray(arr, (0, 1, 0, 4, 0, -1), nodata=-1)
+        mean= Geoprocess(raster).reshape((2, 3), method='mean')
+        self.assertEqual(mean.geotransform, (0, 2, 0, 4, 0, -2))
+        self.assertEqual(mean.nodata, -9999)
+        self.assertEqual(mean.array[0, 0], -9999)
+        self.assertEqual(mean.array[0, 1], np.mean([2, 3, 8, 9]))
+        self.assertAlmostEqual(mean.array[1, 2], np.mean([17, 22, 23]), places=5)    #nan skipped
+        total= Geoprocess(raster).reshape((2, 3), method='sum')
+        self.assertEqual(total.array[0, 0], -9999)
+        self.assertEqual(total.array[1, 2], 17+22+23)
+        self.assertEqual(Geoprocess(raster).reshape((1, 1), method='max').array[0, 0], 23)
+
+    def test_latsplit(self):
+        arr= np.ones((180,360), dtype=np.float32)
+        raster= io.Raster.fromArray(arr, (-180, 1, 0, 90, 0, -1))
+        bands= Geoprocess(raster).latSplit(del_deg=30)
+        self.assertEqual(list(bands.keys())[0], '90S-60S')
+        self.assertEqual(bands['0N-30N'], 30*360)
+        weighted= Geoprocess(raster).latSplit(del_deg=30, metric='mean', weighted=True)
+        self.assertAlmostEqual(weighted['60N-90N'], 1.0)
+
+    def test_clip(self):
+        arr= np.arange(100, dtype=np.float32).reshape(10,10)
+        raster= io.Raster.fromArray(arr, (0, 1, 0, 10, 0, -1), crs='EPSG:4326')
+        with tempfile.TemporaryDirectory() as folder:
+            for extent in ([0.6, 3.4, 2.2, 7.7], [2, 5, 1, 4], [0.4, 3.6, 0.5, 9.5]):
+                fast= Geoprocess(raster).rasterClipByExt(extent)                       #numpy slicing
+                dst= os.path.join(folder, 'clip.tif')
+                translated= Geoprocess(raster).rasterClipByExt(extent, dst=dst)      #gdal.Translate
+                self.assertEqual(fast.shape, translated.shape)
+                self.assertTrue(np.allclose(fast.geotransform, translated.geotransform))
+                self.assertTrue(np.array_equal(fast.array, translated.array))
+            mask= io.Vector.fromFrame(gpd.GeoDataFrame(geometry=[shapely.box(2, 2, 6, 6)], crs='EPSG:4326'))
+            clipped= Geoprocess(raster).rasterClipByMask(mask, nodata=-1).array
+            self.assertEqual((clipped!=-1).sum(), 16)
+            self.assertTrue(np.array_equal(clipped[4:8, 2:6], arr[4:8, 2:6]))
+
+    def test_zonal_nested(self):
+        raster= io.Raster.fromArray(np.ones((10,10), dtype=np.float32), (0, 1, 0, 10, 0, -1))
+        basins= gpd.GeoDataFrame(geometry=[shapely.box(0, 0, 10, 10), shapely.box(2, 2, 6, 6)])
+        stats= Geoprocess(raster).zonalStats(io.Vector.fromFrame(basins), metrics=['count'])
+        self.assertEqual(list(stats['count']), [100, 16])                          #nested pixels in both
+
+    def test_clip_masks(self):
+        arr= np.arange(100, dtype=np.float32).reshape(10,10)
+        raster= io.Raster.fromArray(arr, (0, 1, 0, 10, 0, -1))
+        basins= gpd.GeoDataFrame(geometry=[shapely.box(0, 0, 10, 10), shapely.box(2, 2, 6, 6), shapely.box(20, 20, 21, 21)])
+        clips= dict(Geoprocess(raster).rasterClipByMasks(io.Vector.fromFrame(basins), output='values'))
+        self.assertEqual(len(clips[0]), 100)                                       #upstream pixels kept
+        self.assertEqual(sorted(clips[1]), sorted(arr[4:8, 2:6].ravel()))
+        self.assertIsNone(clips[2])
+        clipped= dict(Geoprocess(raster).rasterClipByMasks(io.Vector.fromFrame(basins), output='array', nodata=-1))
+        self.assertEqual(clipped[1].shape, (4, 4))
+
+    def test_point_sample(self):
+        arr= np.arange(16, dtype=np.float32).reshape(4,4)
+        arr[1, 1]= -9999
+        raster= io.Raster.fromArray(arr, (0, 1, 0, 4, 0, -1), nodata=-9999)
+        points= io.Vector.fromFrame(gpd.GeoDataFrame(geometry=gpd.points_from_xy([1.2, 1.5, 2.5, 9], [2.7, 2.5, 1.5, 1])))
+        nearest= Geoprocess(raster).pointSample(points)['samples']
+        self.assertTrue(np.isnan(nearest[1]))                                       #nodata pixel
+        self.assertEqual(nearest[2], 10)
+        bilinear= Geoprocess(raster).pointSample(points, method='bilinear')['samples']
+        self.assertAlmostEqual(bilinear[0], (1*0.14+ 4*0.24)/0.44)                  #nodata neighbour dropped
+        self.assertTrue(np.isnan(bilinear[1]))
+        self.assertAlmostEqual(bilinear[2], 10)
+        self.assertTrue(np.isnan(bilinear[3]))                                      #outside
+        stack= io.Raster.fromArray(np.stack([arr, arr+100]), (0, 1, 0, 4, 0, -1), nodata=-9999)
+        frame= Geoprocess(stack).pointSample(points, method='bilinear', frame=True)
+        self.assertEqual(list(frame.columns), ['lons', 'lats', 'band_1', 'band_2'])
+        self.assertAlmostEqual(frame['band_2'][2], 110)
+        self.assertAlmostEqual(Geoprocess(stack).pointSample(points, band=2)['samples'][2], 110)
+
+    def test_vector_index(self):
+        arr= np.arange(100, dtype=np.float32).reshape(10,10)
+        raster= io.Raster.fromArray(arr, (0, 1, 0, 10, 0, -1))
+        points= gpd.GeoDataFrame({'id': [0, 1, 2]}, geometry=gpd.points_from_xy([0.5, 9.5, 20], [9.5, 0.5, 5]), crs='EPSG:4326')
+        with tempfile.TemporaryDirectory() as folder:
+            filename= os.path.join(folder, 'points.shp')
+            points.to_file(filename)
+            vector= io.Vector(filename)
+            self.assertEqual(list(vector.query(raster)), [0, 1])                 #outside point filtered
+            tiles= vector.queryTiles(raster, blocksize=(5, 5))
+            self.assertEqual(len(tiles), 2)
+            values= Geoprocess(raster).pointSample(vector, tiled=True)
+            self.assertEqual(values['samples'][0], 0)
+            self.assertEqual(values['samples'][1], 99)
+            self.assertTrue(np.isnan(values['samples'][2]))
+
+    def test_vector_read(self):
+        points= gpd.GeoDataFrame({'id': np.arange(10)*10, 'name': list('abcdefghij')},
+                                 geometry=gpd.points_from_xy(np.arange(10), np.arange(10)), crs='EPSG:4326')
+        with tempfile.TemporaryDirectory() as folder:
+            filename= os.path.join(folder, 'points.shp')
+            points.to_file(filename)
+            vector= io.Vector(filename, bbox=(3.5, 3.5, 6.5, 6.5))
+            self.assertEqual(list(vector.layer.index), [4, 5, 6])                     #feature ids kept
+            self.assertEqual(list(vector.layer['id']), [40, 50, 60])
+            vector= io.Vector(filename, mask=shapely.box(6.5, 6.5, 9.5, 9.5), columns=['name'])
+            self.assertEqual(list(vector.layer.index), [7, 8, 9])
+            self.assertEqual(list(vector.layer.columns), ['name', 'geometry'])
+            self.assertEqual(list(io.Vector(filename, rows=slice(2, 5)).layer.index), [2, 3, 4])
+            lazy= io.Vector(filename, rows=slice(2, 5), lazy=True)
+            self.assertIsNone(lazy._layer)                                           #not read yet
+            self.assertIs(lazy.layer, io.Vector(filename, rows=slice(2, 5)).layer)   #cached frame reused
+            self.assertIsNot(lazy.layer, io.Vector(filename, rows=slice(2, 6)).layer)
+
+    def test_crs_alignment(self):
+        arr= np.arange(100, dtype=np.float32).reshape(10,10)
+        raster= io.Raster.fromArray(arr, (0, 100000, 0, 1000000, 0, -100000), crs='EPSG:3857')
+        points= gpd.GeoDataFrame(geometry=gpd.points_from_xy([0.5, 8.5], [8.5, 0.5]), crs='EPSG:4326')
+        vector= io.Vector.fromFrame(points)
+        aligned= vector.to_crs(raster.crs)
+        self.assertIs(vector.to_crs(raster.crs), aligned)                          #reprojected once
+        self.assertIs(vector.to_crs('EPSG:4326'), vector)
+        values= Geoprocess(raster).pointSample(vector)
+        self.assertEqual(list(values['lons']), [0.5, 8.5])                         #coordinates of the input crs
+        self.assertEqual(values['samples'][0], 10*np.floor((1000000-aligned.layer.geometry.y[0])/100000)+0)
+
+    def test_readfile(self):
+        with tempfile.TemporaryDirectory() as folder:
+            h5_pth= os.path.join(folder, 'sample.HDF5')
+            with h5py.File(h5_pth, 'w') as f:
+                f['Grid/lats']= np.arange(3)
+            gpkg_pth= os.path.join(folder, 'points.gpkg')
+            gpd.GeoDataFrame(geometry=gpd.points_from_xy([0], [0]), crs='EPSG:4326').to_file(gpkg_pth)
+            self.assertEqual(io.sniffFormat(h5_pth), 'hdf5')
+            self.assertEqual(io.sniffFormat(gpkg_pth), 'gpkg')
+            h5= io.ReadFile(h5_pth).layer
+            self.assertIs(io.ReadFile(h5_pth).layer, h5)                             #pooled handle
+            self.assertIsNot(io.ReadFile(h5_pth, pool=False).layer, h5)
+            self.assertIsInstance(io.ReadFile(gpkg_pth).vector, io.Vector)
+            json_pth= os.path.join(folder, 'points.geojson')
+            gpd.GeoDataFrame(geometry=gpd.points_from_xy([0], [0]), crs='EPSG:4326').to_file(json_pth, driver='GeoJSON')
+            io.registerReader('geojson', 'vector', lambda filename, header: filename.endswith('.geojson'), io.Vector)
+            self.assertEqual(io.sniffFormat(json_pth), 'geojson')                  #ahead of the ogr fallback
+            io._READERS.pop('geojson')
+            io.clearPool()
+            h5.close()
+
+    def test_statistics(self):
+        x= np.random.rand(48, 10, 10)
+        y= x*0.5+ np.random.rand(48, 10, 10)
+        x[np.random.rand(48, 10, 10)<0.1]= np.nan
+        r, mae, normMAE, rmse, normRMSE= StackStats().main(x, y)
+        accumulator= Accumulator((10, 10))
+        for t in range(48):
+            accumulator.update(x[t], y[t])
+        metrics= accumulator.finalize()
+        self.assertTrue(np.allclose(metrics['pearsonr'], r))
+        self.assertTrue(np.allclose(metrics['RMSE'], rmse))
+        self.assertTrue(np.allclose(metrics['normMAE'], normMAE))
+
+    def test_checkpoint(self):
+        maps= np.random.rand(6, 2, 6, 4).astype(np.float32)                            #(time, run, lon, lat)
+        maps[maps<0.1]= -9999.9
+        with tempfile.TemporaryDirectory() as root:
+            for run, folder in enumerate(['2000', '2000_final']):
+                os.makedirs(os.path.join(root, folder, '0601'))
+                for t in range(6):
+                    name= '20000601-S%02d0000-E%02d2959.HDF5'%(t, t)
+                    with h5py.File(os.path.join(root, folder, '0601', name), 'w') as f:
+                        f['Grid/precipitationCal']= maps[t, run][np.newaxis]
+                        f['Grid/lats']= np.arange(4, dtype=np.float32)+0.5
+                        f['Grid/lons']= np.arange(6, dtype=np.float32)+0.5
+
+            def block(end=None, catalog=None):
+                block= Block(root, end=end, catalog=catalog)
+                block.lat_lens, block.lon_lens= 4, 6
+                block.stats= np.zeros((4, 6), dtype=block.stats.dtype)
+                return block
+
+            full= block().main_loop(workers=0)
+            checkpoint= os.path.join(root, 'block.h5')
+            block(end='20000601030000').main_loop(checkpoint=checkpoint, workers=0)
+            self.assertEqual(len(Accumulator.load(checkpoint)[1]), 3)
+            resumed= block().main_loop(checkpoint=checkpoint, workers=0)           #skips the first 3 pairs
+            self.assertEqual(len(Accumulator.load(checkpoint)[1]), 6)
+            for field in ('pearsonr', 'RMSE', 'MAE'):
+                self.assertTrue(np.allclose(resumed[field], full[field], equal_nan=True))
+            self.assertRaises(ValueError, Accumulator.load, checkpoint, (5, 5))
+            store= repack(Catalog(root), os.path.join(root, 'store.h5'), layout='space')
+            for catalog in (None, store):                                              #HDF5 files, repacked store
+                prefetched= block(catalog=catalog).main_loop(workers=2, depth=2)
+                striped= block(catalog=catalog).main_loop(processes=3)                 #3 stripes of the 4 rows
+                for field in ('pearsonr', 'RMSE', 'MAE'):
+                    self.assertTrue(np.allclose(prefetched[field], full[field], equal_nan=True))
+                    self.assertTrue(np.allclose(striped[field], full[field], equal_nan=True))
+            store.close()
+            other= block()
+            other.lat_lens= 5
+            self.assertRaises(ValueError, other.main_loop, checkpoint=checkpoint)
+
+    def test_store(self):
+        maps= np.random.rand(6, 2, 6, 4).astype(np.float32)                            #(time, run, lon, lat)
+        maps[maps<0.1]= -9999.9
+        with tempfile.TemporaryDirectory() as root:
+            for run, folder in enumerate(['2000', '2000_final']):
+                for t in range(6):
+                    day= '0531' if t<3 else '0601'
+                    os.makedirs(os.path.join(root, folder, day), exist_ok=True)
+                    name= '2000%s-S%02d0000-E%02d2959.HDF5'%(day, t, t)
+                    with h5py.File(os.path.join(root, folder, day, name), 'w') as f:
+                        f['Grid/precipitationCal']= maps[t, run][np.newaxis]
+                        f['Grid/lats']= np.arange(4, dtype=np.float32)+0.5
+                        f['Grid/lons']= np.arange(6, dtype=np.float32)+0.5
+            catalog= Catalog(root)
+            files= [early for early, _ in catalog.pairs()]
+            bbox= (1, 4, 1, 3)                                                         #lon 1.5-3.5, lat 1.5-2.5
+            cube, lats, lons= io.readCube(files, bbox)
+            self.assertEqual(cube.shape, (6, 2, 3))
+            self.assertTrue(np.allclose(cube, np.where(maps[:, 0, 1:4, 1:3]<0, np.nan, maps[:, 0, 1:4, 1:3]).transpose(0, 2, 1), equal_nan=True))
+            for layout in ('time', 'space'):
+                store= repack(catalog, os.path.join(root, layout+'.h5'), layout=layout)
+                self.assertTrue(np.allclose(io.readCube(store, bbox)[0], cube, equal_nan=True))
+                selected= io.readCube(store, bbox, start='20000531020000', months=[5, 6])[0]
+                self.assertTrue(np.allclose(selected, cube[2:], equal_nan=True))
+                june= io.readCube(files, bbox, months=[6])[0]
+                self.assertTrue(np.allclose(io.readCube(store, bbox, months=[6])[0], june, equal_nan=True))
+                out= np.zeros((3, 2, 3), dtype=np.float32)
+                store.cube(bbox, end='20000601', out=out)
+                self.assertTrue(np.allclose(out, cube[:3], equal_nan=True))
+                self.assertRaises(ValueError, store.cube, bbox, out=out)                #wrong shape
+                self.assertTrue(np.allclose(store.series(2.5, 1.5), np.where(maps[:, 0, 1, 2]<0, np.nan, maps[:, 0, 1, 2]), equal_nan=True))
+                store.close()
+            self.assertRaises(ValueError, io.readCube, files, (10, 20, 10, 20))         #outside the grid
+
+    def test_catalog(self):
+        with tempfile.TemporaryDirectory() as root:
+            for folder in ['2000', '2000_final']:
+                os.makedirs(os.path.join(root, folder, '0601'))
+                for name in ['20000601-S000000-E002900.HDF5', '20000601-S003000-E005900.HDF5']:
+                    open(os.path.join(root, folder, '0601', name), 'w').close()
+            open(os.path.join(root, '2000', '0601', '20000601-S010000-E012900.HDF5'), 'w').close()
+            catalog= Catalog(root)
+            self.assertEqual(len(catalog.pairs()), 2)
+            self.assertEqual(len(catalog.pairs(start='200006010030')), 1)
+            self.assertEqual(catalog.missing(), ['20000601010000'])
+            self.assertRaises(FileNotFoundError, catalog.pairs, strict=True)
+            self.assertEqual(len(Catalog(root).pairs()), 2)                          #from cached index
+            for folder in ['2001', '2001_final']:
+                os.makedirs(os.path.join(root, folder, '0101'))
+                open(os.path.join(root, folder, '0101', '20010101-S000000-E002900.HDF5'), 'w').close()
+            self.assertEqual(Catalog(root).stale(), [])
+            self.assertEqual(len(Catalog(root).pairs()), 3)                          #new year picked up
+            index= os.path.join(root, 'elsewhere.json')
+            self.assertEqual(len(Block(root, index=index).catalog.pairs()), 3)
+            self.assertTrue(os.path.exists(index))
+            self.assertRaises(ValueError, Block)                                       #no root or catalog
+            cache, folder= os.environ.get('XDG_CACHE_HOME'), tempfile.mkdtemp()
+            os.environ['XDG_CACHE_HOME']= folder
+            os.chmod(root, 0o555)
+            try:
+                catalog= Catalog(root)
+                if not os.access(root, os.W_OK):                                        #superuser ignores permissions
+                    self.assertTrue(catalog.index.startswith(folder))
+                self.assertEqual(len(catalog.pairs()), 3)
+            finally:
+                os.chmod(root, 0o755)
+                shutil.rmtree(folder)
+                if cache is None:
+                    del os.environ['XDG_CACHE_HOME']
+                else:
+                    os.environ['XDG_CACHE_HOME']= cache
+
     def test_dataprocess(self):
         test_arr= np.random.randint(0,100, size=(10,10))
         # trans_arr= normalize(test_arr, 'minmax', feature_range=(0,5))   #Minmax passed